@@ -0,0 +1,221 @@
+"""
+Benchmark Suite
+---------------
+Times every pipeline stage on synthetic data, so performance can be compared
+between versions without sharing real cohorts.
+It includes:
+- A seeded synthetic beta matrix generator (samples x CpGs, up to EPIC size)
+  holding the real clock CpGs (clock_coefficient.txt and, when the models are
+  cached, every CpG read by run_clocks.py) and the overlap CpGs of the
+  intersected data, filled up with synthetic probes
+- Wall time, CPU time and peak RSS of simulation_framework-1/-2, run_clocks,
+  post-simulation_analysis, both enrichment scripts and
+  clocks_weights_based_analysis, each run as its own process, at several
+  scales
+- Per stage, the totals of the instrumentation spans it traced (parse,
+  selection, perturbation, write, predict, ...)
+- A JSON results file, and a comparison with a previous results file that
+  flags stages slower or larger than a tolerance
+
+"""
+
+import os, sys
+import argparse
+import glob
+import json
+import platform
+import shutil
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+from variant_index import load_variant_index, read_coefficient_file
+from instrumentation import TRACE_ENV, add_arguments, configure_from_args, notice, read_trace, span, summarize_trace
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(os.path.dirname(SCRIPTS_DIR), "data")
+EPIC_CPGS = 865918
+DEFAULT_SCALES = ["20x30000", "100x450000"]
+SCALED_STAGES = ["simulation_framework-1", "simulation_framework-2", "run_clocks", "post-simulation_analysis"]
+FIXED_STAGES = ["enrichment_analysis_clocks", "enrichment_analysis_populations", "clocks_weights_based_analysis"]
+# beta matrix rows generated and written per chunk ...
+GENERATE_CHUNKSIZE = 50000
+
+def parse_scale(value):
+    try:
+        samples, cpgs = (int(x) for x in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Scale must be SAMPLESxCPGS (e.g. 100x450000): {value}")
+    if samples < 1 or not 1 <= cpgs <= EPIC_CPGS:
+        raise argparse.ArgumentTypeError(f"Scale must have at least one sample and 1..{EPIC_CPGS} CpGs: {value}")
+    return samples, cpgs
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic beta matrices.")
+    parser.add_argument("--scales", nargs="+", type=parse_scale, default=[parse_scale(scale) for scale in DEFAULT_SCALES],
+                        help="Beta matrix sizes as SAMPLESxCPGS (default: {}; EPIC is {} CpGs)".format(" ".join(DEFAULT_SCALES), EPIC_CPGS))
+    parser.add_argument("--stages", nargs="+", choices=SCALED_STAGES + FIXED_STAGES, default=SCALED_STAGES + FIXED_STAGES, help="Stages to run (default: all)")
+    parser.add_argument("--iterations", type=int, default=2, help="Simulation iterations per framework (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic data and the simulations (default: %(default)s)")
+    parser.add_argument("--mutation-file", default=os.path.join(DATA_DIR, "common_snps", "afr.with_zygosity.txt"), help="Mutation file of the simulations (default: %(default)s)")
+    parser.add_argument("--intersected-data", default=os.path.join(DATA_DIR, "intersected_data"), help="Intersected data directory or variant index (default: %(default)s)")
+    parser.add_argument("--coefficient-file", default=os.path.join(DATA_DIR, "clock_coefficient.txt"), help="Clock coefficient file (default: %(default)s)")
+    parser.add_argument("--summary-file", default=os.path.join(DATA_DIR, "summary_CpG_all_snps.txt"), help="Input of enrichment_analysis_clocks.py (default: %(default)s)")
+    parser.add_argument("--overlap-table", default=os.path.join(DATA_DIR, "gnomAD_overlap_table.snps.csv"), help="Input of enrichment_analysis_populations.py (default: %(default)s)")
+    parser.add_argument("--workdir", default="benchmark_work", help="Directory for the synthetic data and the stage outputs (default: %(default)s)")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic data and outputs of every scale")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file (default: %(default)s)")
+    parser.add_argument("--baseline", default=None, help="Previous JSON results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Relative increase of wall time or peak RSS reported as a regression (default: %(default)s)")
+    add_arguments(parser)
+    return parser.parse_args()
+
+def real_cpgs(coefficient_file, intersected_data):
+    """
+    Clock CpGs of the coefficient file, overlap CpGs of the intersected data and, when the clock models
+    are cached, the CpGs read by run_clocks.py (in that order, without duplicates).
+    """
+    cpgs = list(read_coefficient_file(coefficient_file)["marker"].str.replace("*", "", regex=False))
+    if os.path.isfile(intersected_data) or (os.path.isdir(intersected_data) and os.listdir(intersected_data)):
+        cpgs += list(load_variant_index(intersected_data).variants()["CpG"].str.replace("*", "", regex=False))
+    try:
+        from run_clocks import CLOCKS, clock_sites
+        cpgs += list(clock_sites(CLOCKS) or [])
+    except Exception as error:  # no cached models and no biolearn: the clocks impute the other CpGs ...
+        notice("Clock model CpGs not added ({}) ...".format(error))
+    return list(dict.fromkeys(cpg for cpg in cpgs if cpg))
+
+def generate_beta_matrix(beta_file, n_samples, n_cpgs, seed=1, cpgs=(), chunksize=GENERATE_CHUNKSIZE):
+    """
+    Write a synthetic beta matrix (TSV, ID_REF first) with the given CpGs first, filled up with synthetic
+    probes to n_cpgs rows. Each CpG has a bimodal mean methylation and Beta-distributed samples around it.
+    """
+    rng = np.random.default_rng(seed)
+    cpgs = list(cpgs)[:n_cpgs] if len(cpgs) > n_cpgs else list(cpgs)
+    cpgs += ["cgS{:07d}".format(k) for k in range(n_cpgs - len(cpgs))]
+    samples = ["GSM{:06d}".format(k) for k in range(n_samples)]
+    with open(beta_file, "w") as fOut:
+        fOut.write("\t".join(["ID_REF"] + samples) + "\n")
+        for start in range(0, len(cpgs), chunksize):
+            rows = cpgs[start:start + chunksize]
+            mean = np.clip(rng.beta(0.6, 0.6, size=(len(rows), 1)), 0.01, 0.99)
+            values = rng.beta(mean * 20, (1 - mean) * 20, size=(len(rows), n_samples))
+            pd.DataFrame(values, index=rows).to_csv(fOut, sep="\t", header=False, float_format="%.5f")
+    return beta_file
+
+def run_stage(name, command, cwd):
+    """
+    Run one stage as its own process; returns its wall time, CPU time and peak RSS (of the process and its children)
+    and the totals of the instrumentation spans it traced.
+    """
+    os.makedirs(os.path.join(cwd, "logs"), exist_ok=True)
+    trace_file = os.path.join(cwd, "logs", name + ".trace.jsonl")
+    if os.path.exists(trace_file):
+        os.remove(trace_file)
+    env = dict(os.environ, MPLBACKEND="Agg", **{TRACE_ENV: trace_file})
+    with open(os.path.join(cwd, "logs", name + ".log"), "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    result = {"wall_s": round(wall, 3), "cpu_s": round(usage.ru_utime + usage.ru_stime, 3),
+              "peak_rss_mb": round(usage.ru_maxrss / 1024, 1), "returncode": process.returncode}
+    if os.path.exists(trace_file):
+        result["spans"] = summarize_trace(read_trace(trace_file))
+    notice("{} {:.2f}s wall, {:.2f}s CPU, {:.0f} MB peak{} ...".format(
+        name, wall, result["cpu_s"], result["peak_rss_mb"], "" if process.returncode == 0 else ", FAILED (see logs/{}.log)".format(name)))
+    return result
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPTS_DIR, name + ".py")]
+
+def benchmark_scale(n_samples, n_cpgs, args, cpgs):
+    workdir = os.path.abspath(os.path.join(args.workdir, "{}x{}".format(n_samples, n_cpgs)))
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    beta_file = os.path.join(workdir, "beta.txt")
+    with span("write", items=n_cpgs, samples=n_samples, file=beta_file) as record:
+        generate_beta_matrix(beta_file, n_samples, n_cpgs, args.seed, cpgs)
+    notice("Generated {} samples x {} CpGs in {:.2f}s ...".format(n_samples, n_cpgs, record["wall_s"]))
+    stages = {"generate": {"wall_s": round(record["wall_s"], 3)}}
+    simulation = [args.mutation_file, os.path.abspath(args.intersected_data), beta_file, "--iterations", str(args.iterations), "--seed", str(args.seed)]
+    for stage in SCALED_STAGES:
+        if stage not in args.stages:
+            continue
+        if stage.startswith("simulation_framework"):
+            command = script(stage) + simulation
+        elif stage == "run_clocks":
+            command = script(stage) + [workdir + os.sep, "--force"]
+        else:
+            # the simulated predictions go to their own directory, as post-simulation_analysis.py expects ...
+            predictions = os.path.join(workdir, "predictions")
+            os.makedirs(predictions, exist_ok=True)
+            for file in glob.glob(os.path.join(workdir, "*.simulated_*.biolearn.csv")):
+                shutil.copy(file, predictions)
+            command = script(stage) + [os.path.join(workdir, "beta.biolearn.csv"), predictions]
+        stages[stage] = run_stage(stage, command, workdir)
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"samples": n_samples, "cpgs": n_cpgs, "stages": stages}
+
+def benchmark_fixed(args):
+    # stages whose inputs do not depend on the beta matrix size run once ...
+    workdir = os.path.abspath(os.path.join(args.workdir, "fixed"))
+    os.makedirs(workdir, exist_ok=True)
+    commands = {"enrichment_analysis_clocks": ["-i", args.summary_file, "-o", os.path.join(workdir, "results")],
+                "enrichment_analysis_populations": [args.overlap_table, "-o", os.path.join(workdir, "enrichment_results.csv")],
+                "clocks_weights_based_analysis": [args.coefficient_file, os.path.abspath(args.intersected_data),
+                                                  "--output", os.path.join(workdir, "coefficients_stat.txt")]}
+    return {stage: run_stage(stage, script(stage) + commands[stage], workdir) for stage in FIXED_STAGES if stage in args.stages}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SCRIPTS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(results, baseline, tolerance=0.25):
+    """
+    Stages whose wall time or peak RSS grew by more than tolerance relative to the baseline results.
+    """
+    def stage_table(run):
+        table = {("fixed", stage): values for stage, values in run.get("fixed", {}).items()}
+        for scale in run.get("scales", []):
+            for stage, values in scale["stages"].items():
+                table[("{}x{}".format(scale["samples"], scale["cpgs"]), stage)] = values
+        return table
+    previous = stage_table(baseline)
+    regressions = []
+    for key, values in stage_table(results).items():
+        for metric in ["wall_s", "peak_rss_mb"]:
+            old, new = previous.get(key, {}).get(metric), values.get(metric)
+            if old and new is not None and new > old * (1 + tolerance):
+                regressions.append({"scale": key[0], "stage": key[1], "metric": metric, "baseline": old, "current": new, "ratio": round(new / old, 2)})
+    return regressions
+
+def run_benchmark(args):
+    cpgs = real_cpgs(args.coefficient_file, args.intersected_data)
+    notice("{} real clock/overlap CpGs in the synthetic matrices ...".format(len(cpgs)))
+    results = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "python": platform.python_version(),
+               "platform": platform.platform(), "cpus": os.cpu_count(), "seed": args.seed, "iterations": args.iterations,
+               "real_cpgs": len(cpgs), "scales": [], "fixed": {}}
+    for n_samples, n_cpgs in args.scales:
+        results["scales"].append(benchmark_scale(n_samples, n_cpgs, args, cpgs))
+    results["fixed"] = benchmark_fixed(args)
+    if args.baseline:
+        with open(args.baseline, "r") as fH, span("aggregate", baseline=args.baseline) as record:
+            results["regressions"] = compare_results(results, json.load(fH), args.tolerance)
+            record["items"] = len(results["regressions"])
+        for regression in results["regressions"]:
+            print("WARNING: {stage} ({scale}) {metric} {baseline} -> {current} (x{ratio})".format(**regression))
+    with span("write", items=1, file=args.output), open(args.output, "w") as fOut:
+        json.dump(results, fOut, indent=1)
+    notice("Results written to {} ...".format(args.output))
+    return results
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    configure_from_args(args)
+    results = run_benchmark(args)
+    sys.exit(1 if results.get("regressions") else 0)
@@ -0,0 +1,234 @@
+"""
+Beta Matrix I/O
+---------------
+Shared readers and writers for the DNA methylation beta matrices used by the
+simulation frameworks and run_clocks.py.
+It includes:
+- A chunked reader for the tab-separated beta matrices (ID_REF index, float64)
+- A binary beta store (memory-mapped values with CpG and sample indexes) from
+  which only the needed CpG rows are read
+- An optional compact precision: float32 in memory and uint16-quantized betas
+  on disk (maximum error QUANT_MAX_ERROR, about 7.7e-6 per beta)
+- Sparse "delta" files holding only the simulated cells (CpG, sample, new beta)
+  together with a reference to the base beta matrix
+- Overlaying a delta file on its base matrix
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+DELTA_SUFFIX = ".delta.tsv"
+DELTA_BASE_TAG = "# base_matrix:"
+BETA_CHUNKSIZE = 20000
+BETA_STORE_SUFFIX = ".betastore"
+# compact precision: betas in [0, 1] are stored as round(beta * QUANT_SCALE), QUANT_NAN marks missing values ...
+COMPACT_DTYPE = np.float32
+QUANT_SCALE = 65534
+QUANT_NAN = 65535
+# half a quantization step plus the float32 rounding of values in [0, 1] ...
+QUANT_MAX_ERROR = 0.5 / QUANT_SCALE + 2.0 ** -24
+
+def count_rows(beta_file):
+    with open(beta_file, "rb") as fH:
+        n = sum(block.count(b"\n") for block in iter(lambda: fH.read(1 << 20), b""))
+        fH.seek(-1, os.SEEK_END)
+        last = fH.read(1) if fH.tell() > 0 else b"\n"
+    # the header takes one line, a final line without newline still counts ...
+    return n - 1 + (last != b"\n")
+
+def quantize_betas(values):
+    """
+    Quantize betas to uint16 (values are clipped to [0, 1]; after dequantizing the error is at most QUANT_MAX_ERROR).
+    """
+    values = np.asarray(values)
+    missing = np.isnan(values)
+    quantized = np.rint(np.clip(np.where(missing, 0, values), 0, 1) * QUANT_SCALE).astype(np.uint16)
+    quantized[missing] = QUANT_NAN
+    return quantized
+
+def dequantize_betas(quantized, dtype=COMPACT_DTYPE):
+    values = quantized.astype(dtype)
+    values /= QUANT_SCALE
+    values[quantized == QUANT_NAN] = np.nan
+    return values
+
+def load_beta_matrix(beta_file, cpgs=None, chunksize=BETA_CHUNKSIZE, dtype=np.float64):
+    """
+    Read a tab-separated beta matrix (CpGs x samples, first column ID_REF) in chunks.
+    The values are copied into one preallocated array (float64, or float32 in compact mode),
+    so peak memory stays close to the final matrix. With cpgs, only those rows are kept (in file order).
+    """
+    with open(beta_file, "r") as fH:
+        header = fH.readline().rstrip("\r\n").split("\t")
+    index_name, columns = header[0], header[1:]
+    dtypes = {name: dtype for name in columns}
+    dtypes[index_name] = str
+    chunks = pd.read_csv(beta_file, sep="\t", dtype=dtypes, chunksize=chunksize)
+    if cpgs is not None:
+        wanted = set(cpgs)
+        blocks = [chunk[chunk[index_name].isin(wanted)] for chunk in chunks]
+        data = pd.concat(blocks).set_index(index_name)
+        return pd.DataFrame(data[columns].to_numpy(dtype=dtype), index=data.index, columns=columns, copy=False)
+    values = np.empty((count_rows(beta_file), len(columns)), dtype=dtype)
+    index = []
+    start = 0
+    for chunk in chunks:
+        values[start:start + len(chunk)] = chunk[columns].to_numpy()
+        index.extend(chunk[index_name])
+        start += len(chunk)
+    return pd.DataFrame(values[:start], index=pd.Index(index, name=index_name), columns=columns, copy=False)
+
+def beta_stem(beta_path):
+    """
+    Path of a beta matrix (TSV or store) without its extension, used to name the derived files.
+    """
+    beta_path = beta_path.rstrip(os.sep)
+    for suffix in (BETA_STORE_SUFFIX, ".txt"):
+        if beta_path.endswith(suffix):
+            return beta_path[:-len(suffix)]
+    return beta_path
+
+def is_beta_store(path):
+    return os.path.isfile(os.path.join(path, "values.npy"))
+
+def write_store_index(store_dir, index, header):
+    with open(os.path.join(store_dir, "cpgs.txt"), "w") as fOut:
+        fOut.write("".join(cpg + "\n" for cpg in index))
+    with open(os.path.join(store_dir, "columns.txt"), "w") as fOut:
+        fOut.write("".join(name + "\n" for name in header))
+
+def convert_beta_matrix(beta_file, store_dir=None, chunksize=BETA_CHUNKSIZE, compact=False):
+    """
+    Convert a tab-separated beta matrix into a beta store directory:
+    values.npy (CpGs x samples, float64 or uint16-quantized when compact), cpgs.txt (row index)
+    and columns.txt (index name, then the samples).
+    The values are streamed into the memory-mapped array, so the matrix is never held in memory.
+    """
+    if store_dir is None:
+        store_dir = beta_stem(beta_file) + BETA_STORE_SUFFIX
+    with open(beta_file, "r") as fH:
+        header = fH.readline().rstrip("\r\n").split("\t")
+    index_name, columns = header[0], header[1:]
+    dtypes = {name: np.float64 for name in columns}
+    dtypes[index_name] = str
+    os.makedirs(store_dir, exist_ok=True)
+    values = np.lib.format.open_memmap(os.path.join(store_dir, "values.npy"), mode="w+",
+                                       dtype=np.uint16 if compact else np.float64,
+                                       shape=(count_rows(beta_file), len(columns)))
+    index = []
+    start = 0
+    for chunk in pd.read_csv(beta_file, sep="\t", dtype=dtypes, chunksize=chunksize):
+        block = chunk[columns].to_numpy()
+        values[start:start + len(chunk)] = quantize_betas(block) if compact else block
+        index.extend(chunk[index_name])
+        start += len(chunk)
+    values.flush()
+    del values
+    write_store_index(store_dir, index, header)
+    return store_dir
+
+def write_beta_store(store_dir, df, compact=False):
+    """
+    Write a beta matrix held in memory as a beta store (uint16-quantized when compact).
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    values = df.to_numpy()
+    np.save(os.path.join(store_dir, "values.npy"), quantize_betas(values) if compact else values.astype(np.float64))
+    write_store_index(store_dir, df.index, [df.index.name or "ID_REF"] + list(df.columns))
+    return store_dir
+
+def open_beta_store(store_dir):
+    """
+    Memory-map a beta store and return (values, CpG index, sample columns); no values are read yet.
+    """
+    values = np.load(os.path.join(store_dir, "values.npy"), mmap_mode="r")
+    with open(os.path.join(store_dir, "columns.txt"), "r") as fH:
+        header = fH.read().splitlines()
+    with open(os.path.join(store_dir, "cpgs.txt"), "r") as fH:
+        index = pd.Index(fH.read().splitlines(), name=header[0])
+    return values, index, header[1:]
+
+def load_beta_store(store_dir, cpgs=None, dtype=np.float64):
+    """
+    Read the rows of the given CpGs (all rows without cpgs) from a beta store, in store order.
+    Quantized stores are expanded to dtype on the fly.
+    """
+    values, index, columns = open_beta_store(store_dir)
+    if cpgs is not None:
+        rows = np.flatnonzero(index.isin(list(cpgs)))
+        values, index = values[rows], index[rows]
+    if values.dtype == np.uint16:
+        values = dequantize_betas(np.asarray(values), dtype)
+    else:
+        values = np.array(values, dtype=dtype)
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+def load_beta(beta_path, cpgs=None, dtype=np.float64):
+    """
+    Load a beta matrix from a beta store or a TSV file, optionally only the rows of the given CpGs.
+    """
+    if is_beta_store(beta_path):
+        return load_beta_store(beta_path, cpgs, dtype)
+    return load_beta_matrix(beta_path, cpgs, dtype=dtype)
+
+def changed_cells(original, simulated):
+    """
+    Return the cells that differ between two aligned beta blocks as a (CpG, sample, beta) table.
+    """
+    old = original.to_numpy()
+    new = simulated.loc[original.index, original.columns].to_numpy()
+    # NaN cells are never perturbed, so only compare real values ...
+    changed = (old != new) & ~(np.isnan(old) & np.isnan(new))
+    rows, cols = np.nonzero(changed)
+    return pd.DataFrame({
+        "CpG": original.index[rows],
+        "sample": original.columns[cols],
+        "beta": new[rows, cols],
+    })
+
+def write_delta(outfile, base_file, original, simulated):
+    """
+    Write the changed cells of a simulated beta matrix next to a reference to its base matrix.
+    The base path is stored relative to the delta file so output directories can be moved together.
+    """
+    cells = changed_cells(original, simulated)
+    base_ref = os.path.relpath(os.path.abspath(base_file), os.path.dirname(os.path.abspath(outfile)))
+    with open(outfile, "w") as fOut:
+        fOut.write("{} {}\n".format(DELTA_BASE_TAG, base_ref))
+        cells.to_csv(fOut, sep="\t", index=False)
+    return len(cells)
+
+def delta_base(delta_file):
+    """
+    Resolved path of the base matrix of a delta file (from its header line only).
+    """
+    with open(delta_file, "r") as fH:
+        header = fH.readline().rstrip("\n")
+    if not header.startswith(DELTA_BASE_TAG):
+        raise ValueError(f"Not a delta file (missing '{DELTA_BASE_TAG}' header): {delta_file}")
+    base_ref = header[len(DELTA_BASE_TAG):].strip()
+    if not os.path.isabs(base_ref):
+        base_ref = os.path.join(os.path.dirname(os.path.abspath(delta_file)), base_ref)
+    return os.path.normpath(base_ref)
+
+def read_delta(delta_file):
+    """
+    Read a delta file and return the resolved base matrix path and the changed cells.
+    """
+    base_ref = delta_base(delta_file)
+    cells = pd.read_csv(delta_file, sep="\t", skiprows=1, dtype={"CpG": str, "sample": str, "beta": float})
+    return base_ref, cells
+
+def apply_delta(base_df, cells):
+    """
+    Overlay the changed cells on a copy of the base beta matrix.
+    """
+    rows = base_df.index.get_indexer(cells["CpG"])
+    cols = base_df.columns.get_indexer(cells["sample"])
+    if (rows < 0).any() or (cols < 0).any():
+        raise ValueError("Delta cells refer to CpGs or samples missing from the base matrix")
+    values = base_df.to_numpy(copy=True)
+    values[rows, cols] = cells["beta"].to_numpy()
+    return pd.DataFrame(values, index=base_df.index, columns=base_df.columns)
@@ -0,0 +1,32 @@
+import os, sys
+import argparse
+from variant_index import INDEX_SUFFIX, build_variant_index, save_variant_index
+from instrumentation import add_arguments, configure_from_args, notice
+
+def validate_file(path):
+    if not os.path.isfile(path):
+        raise argparse.ArgumentTypeError(f"File not found: {path}")
+    return path
+
+def validate_directory(path):
+    if not os.path.isdir(path):
+        raise argparse.ArgumentTypeError(f"Directory not found: {path}")
+    return path
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compile the intersected data, zygosity files and clock coefficients into one variant index.")
+    parser.add_argument("intersected_data_dir", type=validate_directory, help="Directory containing intersected mutation data")
+    parser.add_argument("zygosity_dir", type=validate_directory, help="Directory with the [population].with_zygosity.txt files")
+    parser.add_argument("coefficient_file", type=validate_file, help="Clock coefficient file: clock_coefficient.txt")
+    parser.add_argument("-o", "--output", default="data/variant_index"+INDEX_SUFFIX, help="Output index file (default: %(default)s)")
+    add_arguments(parser)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    configure_from_args(args)
+    index = build_variant_index(args.intersected_data_dir, args.zygosity_dir, args.coefficient_file)
+    save_variant_index(index, args.output)
+    table = index.table
+    notice("Done compiling {} rows ({} variants, {} CpGs, {} clocks) to {} ...".format(
+        len(table), (table["variant"] != "").sum(), table["CpG"].nunique(), table["clock"].nunique(), args.output))
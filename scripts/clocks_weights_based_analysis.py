@@ -1,162 +1,101 @@
 import os, sys
-from sklearn.preprocessing import StandardScaler
-import math
+import argparse
 import numpy as np
-from scipy.stats import kstest
-from scipy.stats import lognorm
 from scipy.stats import mannwhitneyu
 from scipy.stats import shapiro
-from scipy import stats
 import pandas as pd
-import seaborn as sns
-import plotly.graph_objects as go
-import matplotlib.pyplot as plt
-import json
+from concurrent.futures import ProcessPoolExecutor
+from variant_index import POPULATIONS, load_variant_index
+from instrumentation import add_arguments, configure_from_args, notice, traced
 
-try:
-    if len(sys.argv) < 3:
-        print("USAGE: python clocks_coefficient.txt path_to_intersected_data")
-        exit(0)
-except:
-    pass
-#
-def process_coefficient_file(coefficient_file):
-    fH = open (coefficient_file,"r")
-    lines = fH.readlines()
-    clocks = {}
-    del lines[0]
-    for line in lines:
-        tokens = line.replace("\n","").split("\t")
-        if tokens[0] != "Horvath-pan-mammalian":
-            clocks[tokens[0]] = {"coefficients":[],"CpG":{}}
-        else:
-            clocks[tokens[0]+'-'+tokens[-1]] = {"coefficients":[],"CpG":{}}
-    for line in lines:
-        tokens = line.replace("\n","").split("\t")
-        if tokens[0] != "Horvath-pan-mammalian":
-            absolute_value = abs(float(tokens[2]))
-            clocks[tokens[0]]["coefficients"].append(absolute_value)
-            clocks[tokens[0]]["CpG"][tokens[1]] = {"coefficient":absolute_value ,"scaled_coefficient":"", "mutation":{"afr":"na","amr":"na","ami":"na","asj":"na","fin":"na","nfe":"na","eas":"na","sas":"na","mid":"na","sa":"na"}}
-        else:
-            absolute_value = abs(float(tokens[2]))
-            clocks[tokens[0]+'-'+tokens[-1]]["coefficients"].append(absolute_value)
-            clocks[tokens[0]+'-'+tokens[-1]]["CpG"][tokens[1]] = {"coefficient":absolute_value ,"scaled_coefficient":"", "mutation":{"afr":"na","amr":"na","ami":"na","asj":"na","fin":"na","nfe":"na","eas":"na","sas":"na","mid":"na","sa":"na"}}
-    print("NOTICE: Done reading clocks file...")
-    print("NOTICE: Found {} clocks...".format(len(clocks)))
-    print("======================================")
-    return clocks
+def validate_file(path):
+    if not os.path.isfile(path):
+        raise argparse.ArgumentTypeError(f"File not found: {path}")
+    return path
+
+def validate_intersected_data(path):
+    if not (os.path.isdir(path) or os.path.isfile(path)):
+        raise argparse.ArgumentTypeError(f"Intersected data directory or variant index not found: {path}")
+    return path
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compare the clock coefficients of CpGs with and without common variants.")
+    parser.add_argument("coefficient_file", type=validate_file, help="Clock coefficient file: clock_coefficient.txt")
+    parser.add_argument("intersected_data", type=validate_intersected_data, help="Directory containing intersected mutation data, or a compiled variant index")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for the per-clock statistics (default: 1)")
+    parser.add_argument("--output", default="coefficients_stat.txt", help="Output statistics table (default: %(default)s)")
+    add_arguments(parser)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    configure_from_args(args)
+#
+def clock_name(clock, subclock):
+    # Horvath-pan-mammalian is analysed per sub-clock (clock1/2/3) ...
+    return clock if subclock == "" else clock+'-'+subclock
 #
-def adding_mutation(path,clocks):
+@traced("index_build", items=len)
+def build_clock_table(index):
+    # one row per clock CpG: absolute coefficient and one mutated flag per population ...
     exclude = ['Monika','Carola','Maria']
-    files = os.listdir(path)
-    for file in files:
-        name = file.split('.')
-        population = name[-4]
-        fH = open (path+file,"r")
-        lines = fH.readlines()
-        if population != "sa":
-            del lines[0]
-        else:
-            #continue
-            print()
-        for line in lines:
-            tokens = line.replace("\n","").split(",")
-            if tokens[1] not in exclude:
-                    if tokens[1] == "Horvath-pan-mammalian":
-                        for clock in clocks:
-                            if "Horvath-pan-mammalian" in clock:
-                                if tokens[2] in clocks[clock]["CpG"]:
-                                    CpG_mutations = tokens[-1].split(";")
-                                    if len(CpG_mutations) > 1:#multiple mutations...
-                                        clocks[clock]["CpG"][tokens[2]]["mutation"][population] = "mutated"
-                                    else:
-                                        if CpG_mutations[0] != "": # only one mutation...
-                                            clocks[clock]["CpG"][tokens[2]]["mutation"][population] = "mutated"
-                                        else: # no mutation...
-                                            clocks[clock]["CpG"][tokens[2]]["mutation"][population] = "not_mutated"
-                    else:
-                        CpG_mutations = tokens[-1].split(";")
-                        if len(CpG_mutations) > 1:#multiple mutations...
-                            clocks[tokens[1]]["CpG"][tokens[2]]["mutation"][population] = "mutated"
-                        else:
-                            if CpG_mutations[0] != "": # only one mutation...
-                                clocks[tokens[1]]["CpG"][tokens[2]]["mutation"][population] = "mutated"
-                            else: # no mutation...
-                                clocks[tokens[1]]["CpG"][tokens[2]]["mutation"][population] = "not_mutated"
-    print("NOTICE: Done adding the mutatations...")
+    table = index.table[index.table["coefficient"].notna() & ~index.table["clock"].isin(exclude)].copy()
+    table["clock"] = [clock_name(clock, subclock) for clock, subclock in zip(table["clock"], table["subclock"])]
+    table["mutated"] = table["variant"] != ""
+    flags = pd.crosstab([table["clock"], table["CpG"]], table["population"], values=table["mutated"], aggfunc="any")
+    # populations without a row for the CpG are NaN in the crosstab; only True counts as mutated ...
+    flags = flags.reindex(columns=POPULATIONS, fill_value=False).eq(True)
+    coefficients = table.drop_duplicates(["clock","CpG"]).set_index(["clock","CpG"])["coefficient"].abs()
+    clock_table = flags.reindex(coefficients.index, fill_value=False)
+    clock_table.insert(0, "coefficient", coefficients)
+    clock_table = clock_table.reset_index()
+    # standardised coefficients (as StandardScaler: population standard deviation), aligned by row ...
+    grouped = clock_table.groupby("clock", sort=False)["coefficient"]
+    std = grouped.transform(lambda values: values.std(ddof=0)).replace(0, 1)
+    clock_table.insert(3, "scaled_coefficient", (clock_table["coefficient"] - grouped.transform("mean")) / std)
+    clock_table.insert(4, "mutated", clock_table[POPULATIONS].any(axis=1))
+    notice("Found {} clocks...".format(clock_table["clock"].nunique()))
     print("======================================")
-    return clocks
+    return clock_table
 #
-def analyzing_clocks(clocks):
-    fOut = open ("coefficients_stat.txt","w")
-    fOut.write("clock\tmCpG_mean\tnmCpG_mean\tmCpG_median\tnmCpG_median\tnomalicy_test(shapiro)\tnon-parametric(mann-whitney u test)\n")
-
-    data_scaled_all = {};data_all={}
-    output = {}
-    for clock in clocks:
-        data_scaled_all[clock] = []
-        data_all[clock]= {}
-        output[clock] = {"scaled_data":{"normal_distribution_test":0,"enrichment_test":{"t-test":0,"non-parametric":0}} ,
-                        "not_scaled_data":{"normal_distribution_test":0,"enrichment_test":{"t-test":0,"non-parametric":0}} 
-                        }
-        data = np.array(clocks[clock]["coefficients"])
-        # Reshape the data to have two dimensions 
-        #checked for the data order, and the ordered satyed unchanged...
-        data = data.reshape(-1, 1)
-        data_all[clock] = data
-        #test for data distribution...
-        result = kstest(data, 'norm')
-        normalicy_stat,normalicy_p_value =  shapiro(data)
-        # Initialize StandardScaler
-        scaler = StandardScaler()
-        # Fit scaler to your data to compute mean and standard deviation
-        scaler.fit(data)
-        # Transform your data using the fitted scaler
-        data_scaled = scaler.transform(data)
-        data_scaled_all[clock] = data_scaled
-        #test for data distribution...
-        result_scaled = kstest(data_scaled, 'norm')
-        output[clock]["not_scaled_data"]["normal_distribution_test"] = result_scaled[1][0]
-        # adding the scale data to clocks...
-        for x in range(len(data)):
-            for CpG in clocks[clock]["CpG"]:
-                if data[x] == clocks[clock]["CpG"][CpG]["coefficient"]:
-                    clocks[clock]["CpG"][CpG]["scaled_coefficient"] = data_scaled[x][0]
-        print("NOTICE: Done scaling coefficients values...")
-        #prepare data for stats...
-        mCpG = []; nmCpG = []
-        for CpG in clocks[clock]["CpG"]:
-            # ckeck for mutations (in all the populations)...
-            mutations_check = 0
-            for population in clocks[clock]["CpG"][CpG]["mutation"]:
-                if clocks[clock]["CpG"][CpG]["mutation"][population] == "mutated":
-                    mutations_check +=1
-            if mutations_check > 0:
-                mCpG.append(clocks[clock]["CpG"][CpG]["coefficient"])
-            else:
-                nmCpG.append(clocks[clock]["CpG"][CpG]["coefficient"])
-        #run stats...
-
-        # non-parametric...
-        non_parametric_p_value = mannwhitneyu(mCpG, nmCpG,alternative="two-sided").pvalue
-
-        print("non-scaled nomalicy test:{}".format(normalicy_p_value))
-        print("non-scaled non-parametric p-value:{}".format(non_parametric_p_value))
-   
-        #
-        output[clock]["scaled_data"]["enrichment_test"]["non-parametric"] = non_parametric_p_value
-        #output[clock]["not_scaled_data"]["enrichment_test"]["non-parametric"] = non_parametricp_value_scaled
-
-        print("=================={}====================".format(clock))
-  
-        fOut.write("{}\t{}\t{}\t{}\t{}\t{}\t{}s\n".format(clock,np.mean(mCpG),np.mean(nmCpG),np.median(mCpG),np.median(nmCpG),normalicy_p_value,non_parametric_p_value))
-        
+def clock_statistics(clock, coefficients, mutated):
+    # normality of the coefficients and Mann-Whitney U test of mutated vs not mutated CpGs ...
+    mCpG = coefficients[mutated]; nmCpG = coefficients[~mutated]
+    normalicy_stat,normalicy_p_value = shapiro(coefficients)
+    non_parametric_p_value = mannwhitneyu(mCpG, nmCpG,alternative="two-sided").pvalue if len(mCpG) and len(nmCpG) else np.nan
+    return {"clock":clock,
+            "mCpG_mean":np.mean(mCpG) if len(mCpG) else np.nan, "nmCpG_mean":np.mean(nmCpG) if len(nmCpG) else np.nan,
+            "mCpG_median":np.median(mCpG) if len(mCpG) else np.nan, "nmCpG_median":np.median(nmCpG) if len(nmCpG) else np.nan,
+            "nomalicy_test(shapiro)":normalicy_p_value, "non-parametric(mann-whitney u test)":non_parametric_p_value}
+#
+def _clock_statistics(task):
+    return clock_statistics(*task)
 
-    return 
+@traced("aggregate", items=len)
+def analyzing_clocks(clock_table, workers=1, ofile="coefficients_stat.txt"):
+    tasks = [(clock, group["coefficient"].to_numpy(), group["mutated"].to_numpy())
+             for clock, group in clock_table.groupby("clock", sort=False)]
+    if workers > 1 and len(tasks) > 1:
+        # the clocks are independent, so their statistics run on a pool of processes ...
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_clock_statistics, tasks))
+    else:
+        results = [_clock_statistics(task) for task in tasks]
+    fOut = open (ofile,"w")
+    fOut.write("clock\tmCpG_mean\tnmCpG_mean\tmCpG_median\tnmCpG_median\tnomalicy_test(shapiro)\tnon-parametric(mann-whitney u test)\n")
+    for result in results:
+        print("non-scaled nomalicy test:{}".format(result["nomalicy_test(shapiro)"]))
+        print("non-scaled non-parametric p-value:{}".format(result["non-parametric(mann-whitney u test)"]))
+        print("=================={}====================".format(result["clock"]))
+        fOut.write("{}\t{}\t{}\t{}\t{}\t{}\t{}s\n".format(result["clock"],result["mCpG_mean"],result["nmCpG_mean"],result["mCpG_median"],result["nmCpG_median"],
+                                                       result["nomalicy_test(shapiro)"],result["non-parametric(mann-whitney u test)"]))
+    fOut.close()
+    return pd.DataFrame(results)
 #
 
 if __name__ =="__main__":
-    clocks = process_coefficient_file(sys.argv[1])
-    clocks = adding_mutation(sys.argv[2],clocks)
-    analyzing_clocks(clocks)
+    # compiled variant index, or the intersected data directory compiled with the coefficient file ...
+    index = load_variant_index(args.intersected_data, coefficient_file=args.coefficient_file)
+    clock_table = build_clock_table(index)
+    notice("Done adding the mutatations...")
+    analyzing_clocks(clock_table, workers=args.workers, ofile=args.output)
@@ -0,0 +1,32 @@
+import os, sys
+import argparse
+from beta_io import BETA_CHUNKSIZE, BETA_STORE_SUFFIX, beta_stem, convert_beta_matrix, open_beta_store
+from instrumentation import add_arguments, configure_from_args, notice, span
+
+def validate_file(path):
+    if not os.path.isfile(path):
+        raise argparse.ArgumentTypeError(f"File not found: {path}")
+    return path
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Convert tab-separated beta matrices into memory-mapped beta stores.")
+    parser.add_argument("beta_files", nargs="+", type=validate_file, help="DNA methylation beta matrix files (TSV format)")
+    parser.add_argument("--outdir", default=None, help="Directory for the stores (default: next to each beta matrix)")
+    parser.add_argument("--compact", action="store_true", help="Store uint16-quantized betas (max error about 7.7e-6) instead of float64")
+    parser.add_argument("--chunksize", type=int, default=BETA_CHUNKSIZE, help="Rows read per chunk (default: %(default)s)")
+    add_arguments(parser)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    configure_from_args(args)
+    for beta_file in args.beta_files:
+        store_dir = None
+        if args.outdir:
+            os.makedirs(args.outdir, exist_ok=True)
+            store_dir = os.path.join(args.outdir, os.path.basename(beta_stem(beta_file)) + BETA_STORE_SUFFIX)
+        with span("write", file=beta_file) as record:
+            store_dir = convert_beta_matrix(beta_file, store_dir, chunksize=args.chunksize, compact=args.compact)
+            values, index, columns = open_beta_store(store_dir)
+            record["items"] = len(index)
+        notice("Done converting {} ({} CpGs x {} samples) to {} ...".format(beta_file, len(index), len(columns), store_dir))
@@ -4,9 +4,12 @@ Epigenetic Clock Enrichment Analysis
 ------------------------------------
 This script computes the enrichment of genetic mutations in CpG sites used by epigenetic clocks across populations.
 It includes:
-- Fisher's exact test per clock vs. others per population
+- Fisher's exact test per clock vs. others per population (all tables tested at once)
+- Per-CpG (population vs. other populations) and per-AF-bin (clock vs. others) enrichment
+  from the variant index
 - FDR-adjusted p-values (Benjamini-Hochberg)
 - Relative Risk (RR) calculation
+- Optional empirical p-values from clock label permutations and bootstrap RR intervals
 - Heatmap generation for both metrics
 - CSV export of p-values
 
@@ -14,93 +17,115 @@ It includes:
 
 import pandas as pd
 import numpy as np
-from scipy.stats import fisher_exact
 from statsmodels.stats.multitest import multipletests
 import seaborn as sns
 import matplotlib.pyplot as plt
 import argparse
 import os
+from enrichment_stats import fisher_exact_batch, clock_vs_others, relative_risk, permutation_test, bootstrap_relative_risk, RESAMPLING_BATCH
+from simulation_runtime import master_entropy
+from variant_index import load_variant_index
+from instrumentation import add_arguments, configure_from_args, notice, span, traced
 
+EXCLUDED_CLOCKS = ['Monika', 'Carola', 'Maria']
+
+@traced("parse", items=len)
 def load_data(filepath):
     df = pd.read_csv(filepath)
-    exclude = ['Monika', 'Carola', 'Maria']
-    df = df[~df['clock'].isin(exclude)].reset_index(drop=True)
+    df = df[~df['clock'].isin(EXCLUDED_CLOCKS)].reset_index(drop=True)
     return df
 
+def clock_tables(df, populations):
+    # clock vs. other clocks tables, one row per population and one column per clock ...
+    mutated = df[[f"{pop}_site_with_mutations" for pop in populations]].to_numpy(dtype=np.int64).T
+    not_mutated = df[[f"{pop}_site_without_mutations" for pop in populations]].to_numpy(dtype=np.int64).T
+    return clock_vs_others(mutated, not_mutated)
+
+@traced("aggregate", items=lambda result: len(result[0]))
 def compute_fisher_with_fdr(df, populations):
-    population_columns = {
-        pop: (f"{pop}_site_with_mutations", f"{pop}_site_without_mutations") for pop in populations
-    }
     clock_names = df['clock'].tolist()
-    raw_p = []
-    fisher_results = {pop: [] for pop in populations}
-
-    for pop in populations:
-        mut_col, nomut_col = population_columns[pop]
-        for i in range(len(clock_names)):
-            this_mut = df.loc[i, mut_col]
-            this_nomut = df.loc[i, nomut_col]
-            others_mut = df[mut_col].sum() - this_mut
-            others_nomut = df[nomut_col].sum() - this_nomut
-            table = np.array([[this_mut, this_nomut], [others_mut, others_nomut]])
-            _, p = fisher_exact(table, alternative='two-sided')
-            raw_p.append(p)
-            fisher_results[pop].append(p)
+    # all the population x clock tables are tested at once ...
+    raw_p = fisher_exact_batch(*clock_tables(df, populations)).ravel()
 
     # Adjust p-values
     adj_p = multipletests(raw_p, method='fdr_bh')[1]
 
     # Build result table
-    table = []
-    i = 0
-    for pop in populations:
-        for clock in clock_names:
-            table.append([pop, clock, raw_p[i], adj_p[i]])
-            i += 1
-    pval_df = pd.DataFrame(table, columns=["Population", "Clock", "Raw_p", "Adjusted_p"])
+    pval_df = pd.DataFrame({"Population": np.repeat(populations, len(clock_names)), "Clock": np.tile(clock_names, len(populations)),
+                            "Raw_p": raw_p, "Adjusted_p": adj_p})
 
     # Matrix for heatmap
-    matrix = []
-    index = 0
-    for pop in populations:
-        row = []
-        for _ in clock_names:
-            val = adj_p[index]
-            row.append(-np.log10(val) if val > 0 else 0)
-            index += 1
-        matrix.append(row)
+    with np.errstate(divide='ignore'):
+        matrix = np.where(adj_p > 0, -np.log10(adj_p), 0).reshape(len(populations), len(clock_names))
     matrix_df = pd.DataFrame(matrix, index=populations, columns=clock_names)
     matrix_df.loc['average'] = matrix_df.mean(axis=0)
 
     return pval_df, matrix_df
 
+@traced("aggregate", items=lambda rr_df: rr_df.size)
 def compute_relative_risk(df, populations):
-    rr_matrix = []
     clock_names = df['clock'].tolist()
-    population_columns = {
-        pop: (f"{pop}_site_with_mutations", f"{pop}_site_without_mutations") for pop in populations
-    }
-
-    for pop in populations:
-        mut_col, nomut_col = population_columns[pop]
-        row = []
-        for i in range(len(clock_names)):
-            a = df.loc[i, mut_col]
-            b = df.loc[i, nomut_col]
-            a_total = a + b
-
-            others_mut = df[mut_col].sum() - a
-            others_total = others_mut + df[nomut_col].sum() - b
-
-            clock_risk = a / a_total if a_total > 0 else 0
-            others_risk = others_mut / others_total if others_total > 0 else 0
-            rr = clock_risk / others_risk if others_risk > 0 else np.nan
-            row.append(rr)
-        rr_matrix.append(row)
-    rr_df = pd.DataFrame(rr_matrix, index=populations, columns=clock_names)
+    rr_df = pd.DataFrame(relative_risk(*clock_tables(df, populations)), index=populations, columns=clock_names)
     rr_df.loc['average'] = rr_df.mean(axis=0)
     return rr_df
 
+@traced("aggregate", items=len)
+def compute_permutation_enrichment(df, populations, permutations, bootstraps, seed=None, workers=1, batch_size=RESAMPLING_BATCH):
+    # empirical p-values (with their Monte-Carlo error) and bootstrap RR intervals of each clock vs. the others ...
+    clock_names = df['clock'].tolist()
+    entropy = master_entropy(seed)
+    notice("Master seed {} ...".format(entropy))
+    tables = clock_tables(df, populations)
+    empirical_p, mc_error = permutation_test(tables[0], tables[1], permutations, entropy, workers, batch_size)
+    notice("Done {} permutations ...".format(permutations))
+    low, high = bootstrap_relative_risk(*tables, bootstraps, entropy, workers, batch_size)
+    notice("Done {} bootstrap samples ...".format(bootstraps))
+    return pd.DataFrame({"Population": np.repeat(populations, len(clock_names)), "Clock": np.tile(clock_names, len(populations)),
+                         "RR": relative_risk(*tables).ravel(), "RR_CI_low": low.ravel(), "RR_CI_high": high.ravel(),
+                         "Empirical_p": empirical_p.ravel(), "MC_error": mc_error.ravel(),
+                         "Adjusted_p": multipletests(empirical_p.ravel(), method='fdr_bh')[1]})
+
+@traced("aggregate", items=len)
+def compute_cpg_enrichment(index, populations):
+    # per CpG and population: [[variants of the population at the CpG, variants of the other populations at the CpG],
+    #                           [variants of the population at the other clock CpGs, variants of the other populations there]] ...
+    variants = index.variants()
+    variants = variants[variants["population"].isin(populations)].drop_duplicates(["population", "variant", "CpG"])
+    counts = pd.crosstab(variants["CpG"], variants["population"]).reindex(columns=populations, fill_value=0)
+    a = counts.to_numpy(dtype=np.int64)
+    cpg_total = a.sum(axis=1, keepdims=True); population_total = a.sum(axis=0, keepdims=True)
+    b = cpg_total - a; c = population_total - a; d = a.sum() - cpg_total - population_total + a
+    raw_p = fisher_exact_batch(a, b, c, d).ravel()
+    notice("Tested {} CpG x population tables ...".format(len(raw_p)))
+    return pd.DataFrame({"CpG": np.repeat(counts.index.to_numpy(), len(populations)), "Population": np.tile(populations, len(counts)),
+                         "variants": a.ravel(), "other_population_variants": b.ravel(), "RR": relative_risk(a, b, c, d).ravel(),
+                         "Raw_p": raw_p, "Adjusted_p": multipletests(raw_p, method='fdr_bh')[1]})
+
+@traced("aggregate", items=len)
+def compute_af_bin_enrichment(index, populations, af_bins):
+    # clock vs. other clocks per population, counting a site as mutated when it has a variant with AF in the bin ...
+    table = index.table[index.table["population"].isin(populations) & ~index.table["clock"].isin(EXCLUDED_CLOCKS)]
+    variants = table[table["variant"] != ""]
+    if variants["AF"].isna().all():
+        raise ValueError("The variant index has no allele frequencies: compile it with the zygosity files (--zygosity-dir)")
+    sites = table.drop_duplicates(["population", "clock", "CpG"]).groupby(["population", "clock"]).size()
+    sites = sites.unstack(fill_value=0).reindex(index=populations, fill_value=0)
+    clock_names = sites.columns.tolist()
+    variants = variants.assign(AF_bin=pd.cut(variants["AF"], af_bins, include_lowest=True))
+    mutated = variants.dropna(subset=["AF_bin"]).drop_duplicates(["AF_bin", "population", "clock", "CpG"])
+    mutated = mutated.groupby(["AF_bin", "population", "clock"], observed=False).size()
+    bins = mutated.index.levels[0]
+    mutated = mutated.reindex(pd.MultiIndex.from_product([bins, populations, clock_names]), fill_value=0)
+    mutated = mutated.to_numpy(dtype=np.int64).reshape(len(bins), len(populations), len(clock_names))
+    tables = clock_vs_others(mutated, sites.to_numpy(dtype=np.int64)[None] - mutated)
+    raw_p = fisher_exact_batch(*tables).ravel()
+    notice("Tested {} AF bin x population x clock tables ...".format(len(raw_p)))
+    return pd.DataFrame({"AF_bin": np.repeat(bins.astype(str), len(populations) * len(clock_names)),
+                         "Population": np.tile(np.repeat(populations, len(clock_names)), len(bins)),
+                         "Clock": np.tile(clock_names, len(bins) * len(populations)),
+                         "sites_with_mutations": tables[0].ravel(), "sites_without_mutations": tables[1].ravel(),
+                         "RR": relative_risk(*tables).ravel(), "Raw_p": raw_p, "Adjusted_p": multipletests(raw_p, method='fdr_bh')[1]})
+
 def plot_heatmap(dataframe, title, center_val, outname):
     plt.figure(figsize=(12, 6))
     sns.heatmap(
@@ -122,16 +147,52 @@ def plot_heatmap(dataframe, title, center_val, outname):
     #plt.savefig(outname, dpi=300)
     #plt.close()
     plt.show()
+def parse_af_bins(value):
+    edges = [float(edge) for edge in value.split(",")]
+    if len(edges) < 2 or sorted(edges) != edges:
+        raise argparse.ArgumentTypeError(f"AF bin edges must be increasing and comma-separated: {value}")
+    return edges
+
 def main():
     parser = argparse.ArgumentParser(description="Epigenetic Clocks Mutation Enrichment Analysis")
-    parser.add_argument("-i", "--input", required=True, help="Input summary file")
+    parser.add_argument("-i", "--input", required=False, help="Input summary file (clock mode)")
     parser.add_argument("-o", "--outdir", required=False, default="results", help="Output directory")
+    parser.add_argument("--mode", choices=["clock", "cpg", "af-bin"], default="clock",
+                        help="clock: each clock vs. the others per population (summary file); cpg: each CpG per population vs. the other populations; "
+                             "af-bin: each clock vs. the others per population and AF bin (default: clock)")
+    parser.add_argument("--variant-index", default=None, help="Compiled variant index or intersected data directory (cpg and af-bin modes)")
+    parser.add_argument("--zygosity-dir", default=None, help="Directory of [population].with_zygosity.txt files, for AFs when --variant-index is a directory")
+    parser.add_argument("--af-bins", type=parse_af_bins, default=parse_af_bins("0,0.01,0.05,0.1,0.25,0.5,1"), help="Comma-separated AF bin edges (default: 0,0.01,0.05,0.1,0.25,0.5,1)")
+    parser.add_argument("--permutations", type=int, default=0, help="Clock label permutations for empirical p-values in clock mode (default: 0, off)")
+    parser.add_argument("--bootstraps", type=int, default=10000, help="Bootstrap samples for the RR intervals with --permutations (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=None, help="Master random seed of the permutations and bootstrap samples")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for the permutation batches (default: 1)")
+    parser.add_argument("--batch-size", type=int, default=RESAMPLING_BATCH, help="Permutations per batch (default: %(default)s)")
+    add_arguments(parser)
     args = parser.parse_args()
+    configure_from_args(args)
+    if args.mode == "clock" and args.input is None:
+        parser.error("--input is required in clock mode")
+    if args.mode != "clock" and args.variant_index is None:
+        parser.error("--variant-index is required in {} mode".format(args.mode))
 
     os.makedirs(args.outdir, exist_ok=True)
-    df = load_data(args.input)
     populations = ['afr', 'sas', 'amr', 'eas', 'fin', 'nfe', 'asj', 'ami', 'mid']
 
+    if args.mode != "clock":
+        with span("index_build", file=args.variant_index) as record:
+            index = load_variant_index(args.variant_index, zygosity_dir=args.zygosity_dir)
+            record["items"] = len(index.table)
+        if args.mode == "cpg":
+            cpg_df = compute_cpg_enrichment(index, populations)
+            cpg_df.to_csv(os.path.join(args.outdir, "fisher_fdr_pvalues.cpg.csv"), index=False)
+        else:
+            bin_df = compute_af_bin_enrichment(index, populations, args.af_bins)
+            bin_df.to_csv(os.path.join(args.outdir, "fisher_fdr_pvalues.af_bins.csv"), index=False)
+        return
+
+    df = load_data(args.input)
+
     # Fisher test + FDR
     pval_df, log_fdr_df = compute_fisher_with_fdr(df, populations)
     pval_df.to_csv(os.path.join(args.outdir, "fisher_fdr_pvalues.csv"), index=False)
@@ -142,5 +203,10 @@ def main():
     rr_df.to_csv(os.path.join(args.outdir, "relative_risk_scores.csv"))
     plot_heatmap(rr_df, "Relative Risk", center_val=1, outname=os.path.join(args.outdir, "rr_heatmap.png"))
 
+    # Permutation p-values + bootstrap RR intervals
+    if args.permutations > 0:
+        perm_df = compute_permutation_enrichment(df, populations, args.permutations, args.bootstraps, args.seed, args.workers, args.batch_size)
+        perm_df.to_csv(os.path.join(args.outdir, "permutation_pvalues.csv"), index=False)
+
 if __name__ == "__main__":
     main()
@@ -1,53 +1,58 @@
-
-import sys
+import argparse
 import pandas as pd
 import numpy as np
-from scipy.stats import fisher_exact
 from statsmodels.stats.multitest import multipletests
 import seaborn as sns
 import matplotlib.pyplot as plt
+from enrichment_stats import enrichment_test, wald_rr_interval, ASYMPTOTIC_MIN_EXPECTED, ASYMPTOTIC_TESTS
+from instrumentation import add_arguments, configure_from_args, notice, span
 
-def compute_relative_risk(a, b, c, d):
-    if b == 0 or d == 0:
-        return np.nan
-    pop_risk = a / b
-    if c == 0:
-        other_risk = (c + 0.5) / d  # continuity correction
-    else:
-        other_risk = c / d
-    return pop_risk / other_risk if other_risk > 0 else np.nan
-
-def compute_fisher_pvalue(a, b, c, d):
-    contingency_table = [[a, b - a], [c, d - c]]
-    _, p_value = fisher_exact(contingency_table, alternative='two-sided')
-    return p_value
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Enrichment of each population's SNPs in the clock CpGs vs. the other populations.")
+    parser.add_argument("input_file", help="Overlap table: gnomAD_overlap_table.snps.csv")
+    parser.add_argument("-o", "--output", default=None, help="Write the result table (RR, interval, p-value, FDR and test) to this CSV file")
+    parser.add_argument("--min-expected", type=float, default=ASYMPTOTIC_MIN_EXPECTED,
+                        help="Use the asymptotic test when every expected count is at least this (default: %(default)s)")
+    parser.add_argument("--asymptotic", choices=ASYMPTOTIC_TESTS, default="g-test", help="Asymptotic test for large tables (default: %(default)s)")
+    add_arguments(parser)
+    return parser.parse_args()
 
-def analyze_enrichment(input_file, output_csv, heatmap_path=None):
-    df = pd.read_csv(input_file)
-
-    rr_list = []
-    pval_list = []
+def compute_relative_risk(a, b, c, d):
+    # risk of the population (a/b) over the risk of the other populations (c/d), for whole columns ...
+    a, b, c, d = (np.asarray(x, dtype=np.float64) for x in (a, b, c, d))
+    other_c = np.where(c == 0, c + 0.5, c)  # continuity correction
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rr = (a / b) / (other_c / d)
+    return np.where((b == 0) | (d == 0), np.nan, rr)
 
-    for _, row in df.iterrows():
-        a = row["a (SNPs in pop overlap CpGs)"]
-        b = row["b (All SNPs in pop)"]
-        c = row["c (Other pop SNPs overlap CpGs)"]
-        d = row["d (All SNPs in other pops)"]
+def compute_fisher_pvalue(a, b, c, d, min_expected=ASYMPTOTIC_MIN_EXPECTED, asymptotic="g-test"):
+    # exact test for small tables, asymptotic test for large ones; returns the p-values and the test used ...
+    a, b, c, d = (np.asarray(x, dtype=np.int64) for x in (a, b, c, d))
+    return enrichment_test(a, b - a, c, d - c, min_expected=min_expected, asymptotic=asymptotic)
 
-        rr = compute_relative_risk(a, b, c, d)
-        pval = compute_fisher_pvalue(a, b, c, d)
+def analyze_enrichment(input_file, output_csv, heatmap_path=None, min_expected=ASYMPTOTIC_MIN_EXPECTED, asymptotic="g-test"):
+    with span("parse", file=input_file) as record:
+        df = pd.read_csv(input_file)
+        record["items"] = len(df)
 
-        rr_list.append(rr)
-        pval_list.append(pval)
+    a = df["a (SNPs in pop overlap CpGs)"].to_numpy()
+    b = df["b (All SNPs in pop)"].to_numpy()
+    c = df["c (Other pop SNPs overlap CpGs)"].to_numpy()
+    d = df["d (All SNPs in other pops)"].to_numpy()
 
-    df["RR"] = rr_list
-    df["p_value"] = pval_list
+    with span("aggregate", items=len(df)):
+        df["RR"] = compute_relative_risk(a, b, c, d)
+        df["RR_CI_low"], df["RR_CI_high"] = wald_rr_interval(a, b, np.where(c == 0, c + 0.5, c), d)
+        df["p_value"], df["test"] = compute_fisher_pvalue(a, b, c, d, min_expected, asymptotic)
+    notice("Tests used: {} ...".format(", ".join("{} {}".format(n, test) for test, n in df["test"].value_counts().items())))
 
     # Compute FDR
     df["FDR"] = multipletests(df["p_value"], method='fdr_bh')[1]
 
     # Save result table
-    #df.to_csv(output_csv, index=False)
+    if output_csv:
+        with span("write", items=len(df), file=output_csv):
+            df.to_csv(output_csv, index=False)
 
     # Optional heatmap
     if heatmap_path:
@@ -71,9 +76,14 @@ def analyze_enrichment(input_file, output_csv, heatmap_path=None):
         #plt.savefig(heatmap_path)
         #plt.close()
         plt.show()
+    return df
 if __name__ == "__main__":
+    args = parse_arguments()
+    configure_from_args(args)
     analyze_enrichment(
-        input_file=sys.argv[1],#"variants_overlap_table.snps.csv",
-        output_csv="enrichment_results_with_rr_fdr.csv",
-        heatmap_path="rr_heatmap_corrected.png"
+        input_file=args.input_file,#"variants_overlap_table.snps.csv",
+        output_csv=args.output,#"enrichment_results_with_rr_fdr.csv",
+        heatmap_path="rr_heatmap_corrected.png",
+        min_expected=args.min_expected,
+        asymptotic=args.asymptotic
     )
@@ -0,0 +1,238 @@
+"""
+Enrichment Statistics
+---------------------
+Batched tests over arrays of 2x2 tables [[a, b], [c, d]], shared by the
+enrichment analysis scripts.
+It includes:
+- Two-sided Fisher's exact test for many tables at once, from hypergeometric
+  probabilities built on a cached log-factorial table (same p-values as
+  scipy.stats.fisher_exact)
+- Asymptotic tests for tables with large expected counts (G-test or
+  chi-square with Yates' continuity correction) and Wald intervals of the
+  log relative risk
+- Clock vs. other clocks tables from per-clock site counts
+- Relative risk of the first row vs. the second row
+- Empirical p-values from permutations of the clock labels of the sites
+  (clock sizes preserved) and bootstrap relative risk intervals, drawn in
+  seeded batches (one random stream per batch, so the results do not depend
+  on the number of workers) on a pool of processes
+
+"""
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.special import gammaln
+from scipy.stats import chi2, norm
+from simulation_runtime import iteration_stream
+
+# tables are evaluated in blocks of at most this many (table, support value) cells ...
+FISHER_BLOCK_CELLS = 2**22
+# relative tolerance for tables as probable as the observed one (ties up to rounding) ...
+FISHER_RELATIVE_TOLERANCE = 1e-7
+# permutations / bootstrap samples drawn per batch (one random stream and one task per batch) ...
+RESAMPLING_BATCH = 10000
+# permuted counts this close to the observed distance from the expectation are counted as ties ...
+PERMUTATION_TIE_TOLERANCE = 1e-7
+
+# log(k!) is read from a cached table up to this k, and computed directly above ...
+LOG_FACTORIAL_CACHE_SIZE = 2**20
+# the asymptotic tests are used when every expected count is at least this ...
+ASYMPTOTIC_MIN_EXPECTED = 100
+ASYMPTOTIC_TESTS = ["g-test", "chi2-yates"]
+
+# log(k!) for k = 0, 1, ..., grown when a larger table is seen ...
+_log_factorials = np.zeros(1)
+
+def log_factorials(n):
+    """
+    Cached table of log(k!) for k = 0..n (at least).
+    """
+    global _log_factorials
+    if len(_log_factorials) <= n:
+        _log_factorials = gammaln(np.arange(max(n + 1, 2 * len(_log_factorials)), dtype=np.float64) + 1.0)
+    return _log_factorials
+
+def log_factorial(k):
+    k = np.asarray(k)
+    if k.size == 0 or k.max() < LOG_FACTORIAL_CACHE_SIZE:
+        return log_factorials(int(k.max()) if k.size else 0)[k]
+    # tables of millions of counts would need a table of hundreds of MB ...
+    return gammaln(k + 1.0)
+
+def as_tables(a, b, c, d):
+    # broadcast the four cells to flat int64 arrays ...
+    cells = np.broadcast_arrays(*(np.asarray(x) for x in (a, b, c, d)))
+    shape = cells[0].shape
+    a, b, c, d = (np.asarray(x, dtype=np.int64).ravel() for x in cells)
+    if ((a < 0) | (b < 0) | (c < 0) | (d < 0)).any():
+        raise ValueError("All values in the 2x2 tables must be nonnegative.")
+    return shape, a, b, c, d
+
+def fisher_exact_batch(a, b, c, d):
+    """
+    Two-sided Fisher's exact test p-values of the tables [[a, b], [c, d]] (arrays broadcast together).
+    As scipy.stats.fisher_exact, the p-value is the probability of every table with the same margins
+    that is not more probable than the observed one.
+    """
+    shape, a, b, c, d = as_tables(a, b, c, d)
+    p = np.ones(len(a))
+    if len(a) == 0:
+        return p.reshape(shape)
+    n1 = a + b; n2 = c + d; n = a + c; N = n1 + n2
+    lf = log_factorial
+    # support of the first cell given the margins ...
+    lo = np.maximum(0, n - n2)
+    width = np.minimum(n, n1) - lo + 1
+    const = lf(n1) + lf(n2) + lf(n) + lf(N - n) - lf(N)
+    observed = const - lf(a) - lf(b) - lf(c) - lf(d) + FISHER_RELATIVE_TOLERANCE
+    # tables of similar support width are evaluated together ...
+    order = np.argsort(width, kind="stable")
+    start = 0
+    while start < len(order):
+        stop = min(len(order), start + max(1, FISHER_BLOCK_CELLS // max(int(width[order[start]]), 1)))
+        while stop - start > 1 and (stop - start) * int(width[order[stop - 1]]) > FISHER_BLOCK_CELLS:
+            stop = start + (stop - start) // 2
+        block = order[start:stop]
+        x = lo[block, None] + np.arange(int(width[block].max()))
+        valid = x < (lo[block] + width[block])[:, None]
+        x = np.where(valid, x, lo[block, None])
+        row = n1[block, None]; column = n[block, None]
+        logpmf = const[block, None] - lf(x) - lf(row - x) - lf(column - x) - lf(n2[block, None] - column + x)
+        keep = valid & (logpmf <= observed[block, None])
+        # every table kept: the observed table is the most probable one ...
+        p[block] = np.where(keep.sum(axis=1) == valid.sum(axis=1), 1.0, np.where(keep, np.exp(logpmf), 0.0).sum(axis=1))
+        start = stop
+    return np.minimum(p, 1.0).reshape(shape)
+
+def expected_counts(a, b, c, d):
+    # expected cells under independence of rows and columns (float arrays, a, b, c, d order) ...
+    a, b, c, d = (np.asarray(x, dtype=np.float64) for x in (a, b, c, d))
+    N = a + b + c + d
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return tuple(np.where(N > 0, row * column / N, 0.0) for row, column in
+                     ((a + b, a + c), (a + b, b + d), (c + d, a + c), (c + d, b + d)))
+
+def asymptotic_test(a, b, c, d, test="g-test"):
+    """
+    p-values of the tables [[a, b], [c, d]] from the chi-square distribution with one degree of freedom:
+    the G-test (log-likelihood ratio) or Pearson's chi-square with Yates' continuity correction
+    (as scipy.stats.chi2_contingency with lambda_='log-likelihood', correction=False, or with correction=True).
+    """
+    if test not in ASYMPTOTIC_TESTS:
+        raise ValueError(f"Unknown asymptotic test '{test}', expected one of {ASYMPTOTIC_TESTS}")
+    observed = [np.asarray(x, dtype=np.float64) for x in (a, b, c, d)]
+    expected = expected_counts(a, b, c, d)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if test == "g-test":
+            statistic = 2 * sum(np.where(o > 0, o * np.log(o / e), 0.0) for o, e in zip(observed, expected))
+        else:
+            correction = np.minimum(0.5, np.abs(observed[0] - expected[0]))
+            statistic = sum((np.abs(o - e) - correction) ** 2 / e for o, e in zip(observed, expected))
+    return np.where(np.isfinite(statistic), chi2.sf(statistic, 1), 1.0)
+
+def enrichment_test(a, b, c, d, min_expected=ASYMPTOTIC_MIN_EXPECTED, asymptotic="g-test"):
+    """
+    Fisher's exact test, or the asymptotic test for the tables whose expected counts are all at least
+    min_expected. Returns the p-values and the name of the test used for every table.
+    """
+    shape, a, b, c, d = as_tables(a, b, c, d)
+    large = np.min(expected_counts(a, b, c, d), axis=0) >= min_expected
+    p = np.empty(len(a))
+    p[large] = asymptotic_test(a[large], b[large], c[large], d[large], asymptotic)
+    p[~large] = fisher_exact_batch(a[~large], b[~large], c[~large], d[~large])
+    return p.reshape(shape), np.where(large, asymptotic, "fisher").reshape(shape)
+
+def wald_rr_interval(a, n1, c, n2, level=0.95):
+    """
+    Wald interval of the relative risk (a/n1) / (c/n2) on the log scale, with
+    se(log RR) = sqrt(1/a - 1/n1 + 1/c - 1/n2); NaN when a or c is 0.
+    """
+    a, n1, c, n2 = (np.asarray(x, dtype=np.float64) for x in (a, n1, c, n2))
+    z = norm.ppf(0.5 + level / 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_rr = np.log(a / n1) - np.log(c / n2)
+        se = np.sqrt(1 / a - 1 / n1 + 1 / c - 1 / n2)
+        valid = (a > 0) & (c > 0) & (n1 > 0) & (n2 > 0)
+        return np.where(valid, np.exp(log_rr - z * se), np.nan), np.where(valid, np.exp(log_rr + z * se), np.nan)
+
+def clock_vs_others(mutated, not_mutated, axis=-1):
+    """
+    2x2 tables of every clock (along axis) against the sum of the other clocks:
+    [[mutated, not mutated], [others mutated, others not mutated]].
+    """
+    mutated = np.asarray(mutated, dtype=np.int64)
+    not_mutated = np.asarray(not_mutated, dtype=np.int64)
+    others_mutated = mutated.sum(axis=axis, keepdims=True) - mutated
+    others_not_mutated = not_mutated.sum(axis=axis, keepdims=True) - not_mutated
+    return mutated, not_mutated, others_mutated, others_not_mutated
+
+def relative_risk(a, b, c, d):
+    """
+    Risk a/(a+b) of the first row over the risk c/(c+d) of the second row
+    (a risk is 0 when its row is empty, the ratio is NaN when the second risk is 0).
+    """
+    a, b, c, d = (np.asarray(x, dtype=np.float64) for x in (a, b, c, d))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        risk = np.where(a + b > 0, a / (a + b), 0.0)
+        other_risk = np.where(c + d > 0, c / (c + d), 0.0)
+        return np.where(other_risk > 0, risk / other_risk, np.nan)
+
+def batch_sizes(total, batch_size=RESAMPLING_BATCH):
+    return [min(batch_size, total - start) for start in range(0, total, batch_size)]
+
+def run_batches(worker, tasks, workers=1):
+    # batches are independent, so they run on a pool of processes when workers > 1 ...
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(worker, tasks))
+    return [worker(task) for task in tasks]
+
+def permutation_batch(task):
+    # number of permutations at least as far from the expected mutated count as the observed one ...
+    entropy, batch, size, mutated, sites = task
+    rng = iteration_stream(entropy, batch, stream=0)
+    exceed = np.zeros(mutated.shape, dtype=np.int64)
+    for row in range(len(mutated)):
+        # shuffling the clock labels of the sites draws the mutated count of every clock at once ...
+        draws = rng.multivariate_hypergeometric(sites[row], int(mutated[row].sum()), size=size)
+        expected = sites[row] * mutated[row].sum() / max(sites[row].sum(), 1)
+        distance = np.abs(mutated[row] - expected) - PERMUTATION_TIE_TOLERANCE
+        exceed[row] = (np.abs(draws - expected) >= distance).sum(axis=0)
+    return exceed
+
+def permutation_test(mutated, not_mutated, permutations, entropy, workers=1, batch_size=RESAMPLING_BATCH):
+    """
+    Empirical two-sided p-values of every clock vs. the other clocks (rows of the arrays: populations,
+    columns: clocks), from permutations of the clock labels of the sites within each row that keep the
+    clock sizes. Returns the p-values (with the +1 correction) and their Monte-Carlo standard errors.
+    """
+    mutated = np.atleast_2d(np.asarray(mutated, dtype=np.int64))
+    sites = mutated + np.atleast_2d(np.asarray(not_mutated, dtype=np.int64))
+    tasks = [(entropy, batch, size, mutated, sites) for batch, size in enumerate(batch_sizes(permutations, batch_size))]
+    exceed = np.sum(run_batches(permutation_batch, tasks, workers), axis=0)
+    p = (exceed + 1) / (permutations + 1)
+    return p, np.sqrt(p * (1 - p) / permutations)
+
+def bootstrap_batch(task):
+    # relative risks of one batch of site resamples (binomial resampling of each row of the tables) ...
+    entropy, batch, size, a, b, c, d = task
+    rng = iteration_stream(entropy, batch, stream=1)
+    n1 = a + b; n2 = c + d
+    a_star = rng.binomial(n1, np.divide(a, n1, out=np.zeros(a.shape), where=n1 > 0), size=(size,) + a.shape)
+    c_star = rng.binomial(n2, np.divide(c, n2, out=np.zeros(c.shape), where=n2 > 0), size=(size,) + c.shape)
+    return relative_risk(a_star, n1 - a_star, c_star, n2 - c_star)
+
+def bootstrap_relative_risk(a, b, c, d, bootstraps, entropy, workers=1, batch_size=RESAMPLING_BATCH, level=0.95):
+    """
+    Percentile bootstrap interval of the relative risk of the tables [[a, b], [c, d]]
+    (the sites of each row are resampled with replacement). Returns the lower and upper bounds.
+    """
+    a, b, c, d = (np.asarray(x, dtype=np.int64) for x in (a, b, c, d))
+    tasks = [(entropy, batch, size, a, b, c, d) for batch, size in enumerate(batch_sizes(bootstraps, batch_size))]
+    samples = np.concatenate(run_batches(bootstrap_batch, tasks, workers), axis=0)
+    with warnings.catch_warnings():
+        # resamples without other mutated sites have no relative risk ...
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        low, high = np.nanpercentile(samples, [50 * (1 - level), 50 * (1 + level)], axis=0)
+    return low, high
@@ -0,0 +1,135 @@
+"""
+Instrumentation
+---------------
+Progress messages and timed spans shared by the scripts.
+It includes:
+- NOTICE messages filtered by a verbosity level (0: warnings and results
+  only, 1: progress (default), 2: per-item details such as every perturbed
+  CpG)
+- Named spans for the pipeline phases (parse, index_build, selection,
+  perturbation, write, predict, aggregate) recording wall time, CPU time,
+  peak RSS and item counts
+- A trace file with one JSON record per finished span (JSON Lines), appended
+  by every process of a run, worker processes included
+- The --trace / --verbose / --quiet options of the scripts
+
+The trace file and the verbosity are passed to worker processes and to the
+scripts run by simulation_sweep.py or benchmark.py through the environment.
+"""
+
+import os, sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+from functools import wraps
+
+SPANS = ("parse", "index_build", "selection", "perturbation", "write", "predict", "aggregate")
+TRACE_ENV = "EPICLOCK_TRACE"
+VERBOSITY_ENV = "EPICLOCK_VERBOSITY"
+DEFAULT_VERBOSITY = 1
+
+# names of the spans open in this process (innermost last) ...
+_open_spans = []
+
+def add_arguments(parser):
+    """
+    Add the --trace, --verbose and --quiet options to a script's argument parser.
+    """
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument("--trace", default=None, help="Append one JSON record per timed span (wall/CPU time, peak RSS, items) to this file")
+    group.add_argument("-v", "--verbose", action="count", default=0, help="More messages (-v: per-item details such as every perturbed CpG)")
+    group.add_argument("-q", "--quiet", action="store_true", help="Only warnings and results")
+    return parser
+
+def configure(trace=None, verbose=0, quiet=False):
+    """
+    Set the trace file and the verbosity of this process and of the processes it starts.
+    Options left unset keep the values inherited from the environment.
+    """
+    if trace:
+        os.environ[TRACE_ENV] = os.path.abspath(trace)
+    if quiet or verbose:
+        os.environ[VERBOSITY_ENV] = str(0 if quiet else DEFAULT_VERBOSITY + verbose)
+
+def configure_from_args(args):
+    configure(args.trace, args.verbose, args.quiet)
+
+def verbosity():
+    return int(os.environ.get(VERBOSITY_ENV, DEFAULT_VERBOSITY))
+
+def notice(message, level=1):
+    """
+    Print a NOTICE message when the verbosity is at least level (2 for per-item messages).
+    """
+    if verbosity() >= level:
+        print("NOTICE: {}".format(message))
+
+def write_trace(record):
+    trace_file = os.environ.get(TRACE_ENV)
+    if trace_file:
+        # one write per record, so records of concurrent processes do not interleave ...
+        with open(trace_file, "a") as fOut:
+            fOut.write(json.dumps(record, default=str) + "\n")
+
+@contextmanager
+def span(name, items=None, **attributes):
+    """
+    Time a pipeline phase. The yielded record can be updated inside the block (e.g. record["items"] = n);
+    on exit the wall time, CPU time (of this process) and peak RSS (of this process so far) are added and
+    the record is written to the trace file.
+    """
+    if name not in SPANS:
+        raise ValueError(f"Unknown span {name} (one of {', '.join(SPANS)})")
+    record = dict(attributes, items=items)
+    parent = _open_spans[-1] if _open_spans else None
+    _open_spans.append(name)
+    start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    status = "ok"
+    try:
+        yield record
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _open_spans.pop()
+        record.update(span=name, parent=parent, script=os.path.basename(sys.argv[0]), pid=os.getpid(), start=round(start, 6),
+                      wall_s=round(time.perf_counter() - wall, 6), cpu_s=round(time.process_time() - cpu, 6),
+                      peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), status=status)
+        write_trace(record)
+
+def traced(name, items=None, **attributes):
+    """
+    Decorator running a function inside a span; items(result) gives the item count of the span.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, function=function.__name__, **attributes) as record:
+                result = function(*args, **kwargs)
+                if items is not None:
+                    record["items"] = items(result)
+                return result
+        return wrapper
+    return decorator
+
+def read_trace(trace_file):
+    """
+    Span records of a trace file (one dict per span, in the order they finished).
+    """
+    with open(trace_file, "r") as fH:
+        return [json.loads(line) for line in fH if line.strip()]
+
+def summarize_trace(records):
+    """
+    Per span name: number of spans, total wall and CPU time, total items and the largest peak RSS.
+    """
+    summary = {}
+    for record in records:
+        entry = summary.setdefault(record["span"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "items": 0, "peak_rss_mb": 0.0})
+        entry["count"] += 1
+        entry["wall_s"] += record["wall_s"]
+        entry["cpu_s"] += record["cpu_s"]
+        entry["items"] += record.get("items") or 0
+        entry["peak_rss_mb"] = max(entry["peak_rss_mb"], record["peak_rss_mb"])
+    return {name: {key: round(value, 3) if isinstance(value, float) else value for key, value in entry.items()} for name, entry in summary.items()}
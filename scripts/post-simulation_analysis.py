@@ -5,6 +5,10 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+import warnings
+from enrichment_stats import batch_sizes, run_batches
+from simulation_runtime import master_entropy, iteration_stream
+from instrumentation import add_arguments, configure_from_args, notice, traced
 
 def validate_file(path):
     if not os.path.isfile(path):
@@ -20,33 +24,143 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description="Analyze original and simulation output tables to compute delta age.")
     parser.add_argument("original_table", type=validate_file, help="CSV file containing the original predicted age table")
     parser.add_argument("simulation_tables_dir", type=validate_directory, help="Directory with simulated predicted age tables")
+    parser.add_argument("--bootstraps", type=int, default=0, help="Bootstrap resamples for the confidence intervals of Tables 2, 3 and 5 (default: 0, off)")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the bootstrap intervals (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=None, help="Master random seed of the bootstrap resamples")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for the bootstrap batches (default: 1)")
+    add_arguments(parser)
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_arguments()
+    configure_from_args(args)
     original_table = args.original_table
     simulation_tables_dir = args.simulation_tables_dir
 
 
 
+CLOCKS_OF_INTEREST = ["Horvath", "Hannum", "Levine", "skinHorvath", "PedBE", "DUNEDIN"]
+# resampled (resample, row, clock) cells held per bootstrap batch ...
+BOOTSTRAP_BATCH_CELLS = 2**22
+
+@traced("parse", items=len)
 def read_table(file):
     df = pd.read_csv(file, sep=',', index_col='id')
     #df.set_index('id', inplace=True)
     return df
-def analyze_datasets (original_df,sim_dfs):
 
-  
-    clocks_of_interest = ["Horvath", "Hannum", "Levine", "skinHorvath", "PedBE", "DUNEDIN"] 
-    # (1) Calculate delta_age for each individual across 10 simulations
-    delta_age_per_sim = []
+class RunningStats:
+    """
+    Online (Welford) mean and standard deviation of a stream of equally shaped arrays, per cell.
+    NaN cells are skipped, as pandas does.
+    """
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean_ = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, values):
+        seen = ~np.isnan(values)
+        self.count += seen
+        delta = np.where(seen, values - self.mean_, 0.0)
+        self.mean_ += np.divide(delta, self.count, out=np.zeros_like(delta), where=seen)
+        self.m2 += np.where(seen, delta * (values - self.mean_), 0.0)
+
+    def mean(self):
+        return np.where(self.count > 0, self.mean_, np.nan)
+
+    def std(self, ddof=1):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.count > ddof, np.sqrt(self.m2 / (self.count - ddof)), np.nan)
+
+def simulation_files(simulation_tables_dir):
+    # only the clock predictions (other files, e.g. selection records of older pipeline runs, are skipped) ...
+    return [os.path.join(simulation_tables_dir, file) for file in sorted(os.listdir(simulation_tables_dir)) if file.endswith(".biolearn.csv")]
+
+@traced("aggregate", items=lambda result: len(result[2]["delta_age"]))
+def aggregate_simulations(original_df, sim_files, clocks_of_interest=CLOCKS_OF_INTEREST):
+    """
+    Read the simulated tables one at a time, align each to the original individuals and clocks, and
+    accumulate the absolute delta age and the percent deviation per individual and clock.
+    Memory does not grow with the number of simulations, apart from the per-simulation clock averages
+    (one row per simulation) kept for the bootstrap over simulations.
+    """
+    original = original_df[clocks_of_interest].to_numpy(dtype=float)
+    denominator = np.where(original == 0, np.nan, original)
+    delta_age = RunningStats(original.shape)
+    percent_deviation = RunningStats(original.shape)
+    simulation_means = {"delta_age": [], "percent_deviation": []}
+    for file in sim_files:
+        sim = read_table(file).reindex(index=original_df.index, columns=clocks_of_interest).to_numpy(dtype=float)
+        for name, values, stats in (("delta_age", np.abs(sim - original), delta_age), # using absolute delta age difference...
+                                    ("percent_deviation", (sim - original) / denominator * 100, percent_deviation)):
+            stats.update(values)
+            simulation_means[name].append(nanmean(values, axis=0))
+        notice('Done reading simulation file ...', level=2)
+    simulation_means = {name: np.array(means).reshape(-1, len(clocks_of_interest)) for name, means in simulation_means.items()}
+    return delta_age, percent_deviation, simulation_means
+
+def nanmean(values, axis):
+    with warnings.catch_warnings():
+        # clocks without any value average to NaN ...
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(values, axis=axis)
+
+def bootstrap_batch(task):
+    # clock averages of one batch of resamples: rows drawn with replacement by fancy indexing ...
+    entropy, batch, stream, size, values = task
+    rng = iteration_stream(entropy, batch, stream)
+    rows = rng.integers(0, len(values), size=(size, len(values)))
+    return nanmean(values[rows], axis=1)
+
+def bootstrap_interval(values, bootstraps, entropy, stream=0, workers=1, confidence=0.95):
+    """
+    Percentile bootstrap interval of the column averages of values (rows: individuals or simulations,
+    columns: clocks). Batches have their own random streams, so workers does not change the interval.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return np.full(values.shape[1], np.nan), np.full(values.shape[1], np.nan)
+    batch_size = max(1, BOOTSTRAP_BATCH_CELLS // values.size)
+    tasks = [(entropy, batch, stream, size, values) for batch, size in enumerate(batch_sizes(bootstraps, batch_size))]
+    samples = np.concatenate(run_batches(bootstrap_batch, tasks, workers), axis=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        low, high = np.nanpercentile(samples, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+    return low, high
+
+@traced("aggregate", items=len)
+def bootstrap_summaries(tables, simulation_means, bootstraps, seed=None, workers=1, confidence=0.95, clocks_of_interest=CLOCKS_OF_INTEREST):
+    """
+    Bootstrap intervals of the clock averages of Tables 2, 3 and 5, resampling the individuals
+    (rows of Tables 1, the per-individual std and Table 4) and the simulation replicates
+    (per-simulation clock averages).
+    """
+    entropy = master_entropy(seed)
+    notice("Bootstrap master seed {} ...".format(entropy))
+    rows = []
+    resamplings = [(name, "individuals", table.to_numpy(dtype=float)) for name, table in tables.items()]
+    resamplings += [(name, "simulations", means) for name, means in simulation_means.items()]
+    for stream, (name, resampling, values) in enumerate(resamplings):
+        low, high = bootstrap_interval(values, bootstraps, entropy, stream, workers, confidence)
+        estimate = nanmean(values, axis=0) if len(values) else np.full(len(clocks_of_interest), np.nan)
+        rows.append(pd.DataFrame({"Clock": clocks_of_interest, "Statistic": name, "Resampling": resampling,
+                                  "Estimate": estimate, "CI_low": low, "CI_high": high}))
+    ci_df = pd.concat(rows, ignore_index=True)
+    ci_df.to_csv("bootstrap_confidence_intervals.csv", index=False)
+    return ci_df
+
+def per_individual(original_df, values, clocks_of_interest=CLOCKS_OF_INTEREST):
+    # individuals in id order, as the former groupby(level=0) ...
+    return pd.DataFrame(values, index=original_df.index, columns=clocks_of_interest).sort_index()
+
+def analyze_datasets (original_df,delta_age):
 
-    for sim_df in sim_dfs:
-        delta_age = abs(sim_df[clocks_of_interest] - original_df[clocks_of_interest]) # using absolute delta age difference...
-        delta_age_per_sim.append(delta_age)
-    # Convert the list of delta_age DataFrames to a single DataFrame for averaging
-    delta_age_avg_individuals = pd.concat(delta_age_per_sim).groupby(level=0).mean()
+  
+    # (1) Average delta_age for each individual across the simulations
+    delta_age_avg_individuals = per_individual(original_df, delta_age.mean())
 
-    delta_age_std_individuals = pd.concat(delta_age_per_sim).groupby(level=0).std()
+    delta_age_std_individuals = per_individual(original_df, delta_age.std())
     # (1.b) Generate a heatmap for the average delta age per individual
     #plt.figure(figsize=(10, 12))
     #sns.heatmap(delta_age_avg_individuals, cmap="coolwarm")
@@ -72,23 +186,16 @@ def analyze_datasets (original_df,sim_dfs):
     delta_age_avg_individuals.to_csv("delta_age_avg_individuals.csv", index=True)
     delta_age_avg_clocks_df.to_csv("delta_age_avg_clocks.csv", index=True)
     delta_age_std_clocks_df.to_csv("delta_age_std_clocks.csv", index=True)
-    return
+    return delta_age_avg_individuals, delta_age_std_individuals
 #
 # Adding a function to calculate percent deviation and integrating it into the analysis process
 
-def calculate_percent_deviation(original_df, sim_dfs, clocks_of_interest):
+def calculate_percent_deviation(original_df, percent_deviation, clocks_of_interest=CLOCKS_OF_INTEREST):
     """
-    Calculate percent deviation for each simulation compared to the original data.
+    Average percent deviation of the simulations from the original data (accumulated by aggregate_simulations).
     """
-    percent_deviation_per_sim = []
-
-    for sim_df in sim_dfs:
-        percent_deviation = (
-            (sim_df[clocks_of_interest] - original_df[clocks_of_interest]) / original_df[clocks_of_interest].replace(0, np.nan)) * 100
-        percent_deviation_per_sim.append(percent_deviation)
-
-    # Calculate the average percent deviation across simulations
-    percent_deviation_avg_individuals = pd.concat(percent_deviation_per_sim).groupby(level=0).mean()
+    # Average percent deviation across simulations
+    percent_deviation_avg_individuals = per_individual(original_df, percent_deviation.mean(), clocks_of_interest)
 
     # Calculate the average percent deviation for each clock
     percent_deviation_avg_clocks = percent_deviation_avg_individuals.mean(axis=0)
@@ -100,22 +207,16 @@ def calculate_percent_deviation(original_df, sim_dfs, clocks_of_interest):
 
     return percent_deviation_avg_individuals, percent_deviation_avg_clocks_df
 if __name__ == "__main__":
-    original_df = read_table(sys.argv[1])
-    print('NOTICE: Done reading original file...')
-    files = os.listdir(sys.argv[2])
-    sim_dfs =[]
-    for file in files:
-        sim_df = read_table(sys.argv[2]+file)
-        sim_dfs.append(sim_df)
-        print('NOTICE: Done reading simulation file ...')
-
-    analyze_datasets (original_df,sim_dfs)
-    # Define clocks of interest (you can modify as needed)
-    clocks_of_interest = ["Horvath", "Hannum", "Levine", "skinHorvath", "PedBE", "DUNEDIN"]
+    original_df = read_table(original_table)
+    notice('Done reading original file...')
+    # the simulated tables are streamed, one file in memory at a time ...
+    delta_age, percent_deviation, simulation_means = aggregate_simulations(original_df, simulation_files(simulation_tables_dir), CLOCKS_OF_INTEREST)
+
+    delta_age_avg_individuals, delta_age_std_individuals = analyze_datasets (original_df,delta_age)
     
     # Call the new percent deviation function
     percent_deviation_avg_individuals, percent_deviation_avg_clocks_df = calculate_percent_deviation(
-        original_df, sim_dfs, clocks_of_interest
+        original_df, percent_deviation, CLOCKS_OF_INTEREST
     )
 
     # Print results for verification
@@ -124,4 +225,11 @@ if __name__ == "__main__":
 
     print("\nAverage Percent Deviation per Clock (Table 5):")
     print(percent_deviation_avg_clocks_df)
-    
+
+    # Bootstrap confidence intervals over individuals and over simulations
+    if args.bootstraps > 0:
+        ci_df = bootstrap_summaries({"delta_age": delta_age_avg_individuals, "delta_age_std": delta_age_std_individuals,
+                                     "percent_deviation": percent_deviation_avg_individuals},
+                                    simulation_means, args.bootstraps, args.seed, args.workers, args.confidence, CLOCKS_OF_INTEREST)
+        print("\nBootstrap {:.0%} Confidence Intervals (Table 6):".format(args.confidence))
+        print(ci_df)
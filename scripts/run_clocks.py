@@ -1,19 +1,28 @@
 
 import os, sys
 import argparse
-import sklearn
+import importlib.metadata
 import numpy as np
 import pandas as pd
-from biolearn.data_library import DataLibrary
-from biolearn.model_gallery import ModelGallery
-import seaborn as sn
+from scipy import sparse
 import urllib.request
 from urllib.request import urlopen
 import ssl
 import json
+from beta_io import COMPACT_DTYPE, DELTA_SUFFIX, beta_stem, is_beta_store, load_beta, quantize_betas, dequantize_betas, read_delta, apply_delta, delta_base
+from stage_cache import code_version, path_digest, is_fresh, record_stage
+from instrumentation import add_arguments, configure_from_args, notice, span, traced
+import beta_io
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
+CLOCKS = ['Horvathv1','Hannum','PhenoAge','Horvathv2','PEDBE','DunedinPACE']
+CLOCK_LABELS = {'Horvathv1':'Horvath','Hannum':'Hannum','PhenoAge':'Levine','Horvathv2':'skinHorvath','PEDBE':'PedBE','DunedinPACE':'DUNEDIN'}
+# largest accepted difference between the compact and the float64 predictions (years; pace units for DunedinPACE) ...
+COMPACT_TOLERANCE = 0.01
+# resolved linear clocks are cached here as <clock>-<biolearn version>.npz ...
+MODEL_CACHE_DIR = os.environ.get("CLOCK_MODEL_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "epigenetic_clocks"))
+
 def validate_directory(path):
     if not os.path.isdir(path):
         raise argparse.ArgumentTypeError(f"Directory not found: {path}")
@@ -22,79 +31,362 @@ def validate_directory(path):
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Run epigenetic clocks on simulation input files.")
     parser.add_argument("input_dir", type=validate_directory, help="Path to simulation files directory.")
+    parser.add_argument("--clocks", nargs="+", default=CLOCKS, help="biolearn clock names to run (default: %(default)s)")
+    parser.add_argument("--model-cache", default=MODEL_CACHE_DIR, help="Directory of the cached clock models (default: %(default)s)")
+    parser.add_argument("--no-model-cache", action="store_true", help="Resolve the clocks through biolearn without reading or writing the cache")
+    parser.add_argument("--compact", action="store_true", help="Hold the beta matrices as float32 (uint16 beta stores are always read directly)")
+    parser.add_argument("--check-precision", action="store_true", help="Compare the clocks on each matrix with its compact (uint16/float32) copy")
+    parser.add_argument("--incremental", action="store_true", help="Score each base matrix once and re-score delta files from their changed cells only")
+    parser.add_argument("--force", action="store_true", help="Re-score every matrix, also those whose predictions are up to date")
+    add_arguments(parser)
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_arguments()
+    configure_from_args(args)
     input_dir = args.input_dir
 
     # for file in os.listdir(input_dir): ...
 
-def prepare_mData(beta_file):
-    fH = open (beta_file,"r")
-    lines = fH.readlines()
-    mData = []
-    tokens = lines[0].split("\t")
-    header  = "ProbeID," + ",".join(tokens)
-
-    for line in lines:
-        tokens = line.split("\t")
-        out = ",".join(tokens)
-        mData.append(out)
-    ofile = beta_file.replace(".txt",".prepared.txt")
-    fOut = open (ofile,"w")
-    for line in mData:
-        fOut.write(line)
-    print("DONE!!!")
-    return
-
-def read_file(prepared_file):
-    data = pd.read_csv(prepared_file, sep=",")
-    data.set_index("ID_REF",inplace=True)
+# GeoData-style container expected by the biolearn models ...
+class geodata:
+    def __init__(self, metadata=None,dnam=None, rna=None):
+        self.dnam = dnam
+        self.rna = rna
+        self.metadata = metadata
+
+    def copy(self):
+        # the models replace dnam on the copy (imputation), so the matrix itself is not duplicated ...
+        return geodata(self.metadata, dnam=self.dnam, rna=self.rna)
+
+@traced("parse", items=lambda mdata: len(mdata.dnam))
+def read_file(beta_file, cpgs=None, dtype=np.float64):
+    # read the beta matrix (TSV or beta store) directly, only the clock CpG rows when cpgs is given ...
+    data = load_beta(beta_file, cpgs, dtype)
     # create GeoData instance ...
-    class geodata:
-        def __init__(self, metadata=None,dnam=data, rna=None):
-            self.dnam = data
-            self.rna = rna
-            self.metadata = metadata
-    mdata = geodata(data)
-
-    print("NOTICE: Done reading data from local file ...")
+    mdata = geodata(data, dnam=data)
+
+    notice("Done reading data from local file ...")
     return mdata
 #
-def run_clocks(mDNA):
-    gallery = ModelGallery()
+@traced("parse", items=lambda mdata: len(mdata.dnam))
+def read_delta_file(delta_file, base_matrices, cpgs=None, dtype=np.float64):
+    # overlay the simulated cells on the base matrix (each base matrix is read only once) ...
+    base_file, cells = read_delta(delta_file)
+    if base_file not in base_matrices:
+        base_matrices[base_file] = load_beta(base_file, cpgs, dtype)
+        notice("Done reading base matrix {} ...".format(base_file))
+    # cells outside the loaded rows cannot change the clocks ...
+    cells = cells[cells["CpG"].isin(base_matrices[base_file].index)]
+    data = apply_delta(base_matrices[base_file], cells)
+    mdata = geodata(data, dnam=data)
+    notice("Done overlaying {} simulated cells ...".format(len(cells)))
+    return mdata
+#
+# hybrid_impute (biolearn default imputation) keeps CpGs measured in at least this fraction of samples ...
+IMPUTATION_THRESHOLD = 0.8
+
+# rows read by the non-linear clocks (DunedinPACE normalises its gold-standard CpGs) ...
+CLOCK_SITE_FILES = {"DunedinPACE": "DunedinPACE_Gold_Means.csv"}
+
+_gallery = {}
+
+# linear clock specs loaded in this process, by clock and cache directory ...
+_clock_specs = {}
+
+def get_gallery():
+    # biolearn (and torch) are only imported when a model has to be resolved ...
+    if "gallery" not in _gallery:
+        from biolearn.model_gallery import ModelGallery
+        _gallery["gallery"] = ModelGallery()
+    return _gallery["gallery"]
+
+def model_version():
+    try:
+        return importlib.metadata.version("biolearn")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+def anti_trafo(x, adult_age=20):
+    # inverse of Horvath's log-linear age transformation (as in biolearn) ...
+    return np.where(x < 0, (1 + adult_age) * np.exp(x) - 1, (1 + adult_age) * x + adult_age)
+
+def clock_transform(kind, offset):
+    if kind == "anti_trafo":
+        return lambda raw: anti_trafo(raw + offset)
+    return lambda raw: raw + offset
+
+def fit_transform(transform):
+    # recover the transform parameters of a biolearn model (identity or anti_trafo(sum + offset)) ...
+    probe = np.linspace(-5, 5, 101)
+    observed = np.asarray(transform(probe), dtype=float)
+    for kind, offset in [("identity", 0.0), ("anti_trafo", (observed[-1] - 20) / 21 - probe[-1])]:
+        if np.allclose(clock_transform(kind, offset)(probe), observed, rtol=1e-12, atol=1e-9):
+            return kind, float(offset)
+    return None
+
+def is_linear_clock(gallery, clock):
+    # clocks that are a weighted sum of beta values before their output transform (no preprocessing)
+    # and use the default (sesame 450k hybrid) imputation, so they can share one imputed matrix ...
+    model_def = gallery.model_definitions[clock]["model"]
+    return (model_def["type"] == "LinearMethylationModel" and "preprocess" not in model_def
+            and model_def.get("default_imputation", "sesame_450k") == "sesame_450k")
+
+def build_clock_spec(clock):
+    # resolve a linear clock through biolearn into plain arrays (None for the other clocks) ...
+    gallery = get_gallery()
+    if not is_linear_clock(gallery, clock):
+        return None
+    model = gallery.get(clock)
+    transform = fit_transform(model.transform)
+    if transform is None:
+        return None
+    coefficients = model.coefficients
+    column = "CoefficientTraining" if "CoefficientTraining" in coefficients.columns else "Weight"
+    weights = coefficients[column]
+    intercept = float(weights.get("intercept", 0.0))
+    weights = weights.drop("intercept", errors="ignore")
+    from biolearn.util import get_data_file
+    gold = pd.read_csv(get_data_file("sesame_450k_median.csv"), index_col=0)["median"]
+    gold = gold[~gold.index.duplicated()].reindex(weights.index.unique())
+    return {"clock":clock, "cpgs":weights.index.to_numpy(dtype=str), "weights":weights.to_numpy(dtype=float),
+            "intercept":intercept, "transform":transform, "gold_cpgs":gold.index.to_numpy(dtype=str),
+            "gold":gold.to_numpy(dtype=float)}
+
+def load_clock_spec(clock, cache_dir=MODEL_CACHE_DIR):
+    # a cached spec loads without biolearn; a missing one is resolved once and written to the cache (None: not linear) ...
+    path = os.path.join(cache_dir, "{}-{}.npz".format(clock, model_version())) if cache_dir else None
+    if path and os.path.isfile(path):
+        with np.load(path) as cached:
+            spec = {key: cached[key] for key in cached.files}
+        if not spec["linear"]:
+            return None
+        return {"clock":clock, "cpgs":spec["cpgs"], "weights":spec["weights"], "intercept":float(spec["intercept"]),
+                "transform":(str(spec["transform_kind"]), float(spec["transform_offset"])),
+                "gold_cpgs":spec["gold_cpgs"], "gold":spec["gold"]}
+    spec = build_clock_spec(clock)
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        if spec is None:
+            np.savez(path, linear=False)
+        else:
+            np.savez(path, linear=True, cpgs=spec["cpgs"], weights=spec["weights"], intercept=spec["intercept"],
+                     transform_kind=spec["transform"][0], transform_offset=spec["transform"][1],
+                     gold_cpgs=spec["gold_cpgs"], gold=spec["gold"])
+    return spec
+
+def load_clock_specs(clocks, cache_dir=MODEL_CACHE_DIR):
+    # specs are loaded once per process, then reused by every matrix scored in it ...
+    specs = {}
+    for clock in clocks:
+        if (clock, cache_dir) not in _clock_specs:
+            _clock_specs[(clock, cache_dir)] = load_clock_spec(clock, cache_dir)
+        if _clock_specs[(clock, cache_dir)] is not None:
+            specs[clock] = _clock_specs[(clock, cache_dir)]
+    return specs
+
+def clock_sites(clocks, cache_dir=MODEL_CACHE_DIR):
+    # union of the CpG rows the clocks read (None when a clock may use any row) ...
+    specs = load_clock_specs(clocks, cache_dir)
+    sites = set()
+    for clock in clocks:
+        if clock in specs:
+            sites.update(specs[clock]["cpgs"])
+        elif clock in CLOCK_SITE_FILES:
+            from biolearn.util import get_data_file
+            sites.update(pd.read_csv(get_data_file(CLOCK_SITE_FILES[clock]), index_col=0).index)
+        else:
+            return None
+    return sorted(sites)
+
+def impute_hybrid(dnam, gold, required):
+    # same rule as biolearn's hybrid_impute: row mean for CpGs measured often enough, gold standard otherwise ...
+    subset = dnam.loc[dnam.index.intersection(required)]
+    kept = subset[subset.notna().mean(axis=1) >= IMPUTATION_THRESHOLD]
+    kept = kept.where(kept.notna(), kept.mean(axis=1), axis=0)
+    missing = sorted(set(required) - set(kept.index))
+    no_source = [cpg for cpg in missing if cpg not in gold.index or np.isnan(gold[cpg])]
+    if no_source:
+        raise ValueError(f"Tried to fill the following cpgs but they were missing from cpg_source: {no_source}")
+    if not missing:
+        return kept.sort_index()
+    filled = pd.DataFrame(np.repeat(gold[missing].to_numpy()[:, None], len(dnam.columns), axis=1), index=missing, columns=dnam.columns)
+    return pd.concat([kept, filled]).sort_index()
+
+def pack_linear_clocks(specs, dnam):
+    # impute the union of the clock CpGs once and pack all the coefficients into a sparse CpG x clock matrix ...
+    clocks = list(specs)
+    required = sorted(set().union(*[specs[clock]["cpgs"] for clock in clocks]))
+    gold = pd.concat([pd.Series(specs[clock]["gold"], index=specs[clock]["gold_cpgs"]) for clock in clocks])
+    imputed = impute_hybrid(dnam, gold[~gold.index.duplicated()], required)
+    cpgs = imputed.index
+    rows, cols, values = [], [], []
+    for j, clock in enumerate(clocks):
+        rows.append(cpgs.get_indexer(specs[clock]["cpgs"]))
+        cols.append(np.full(len(specs[clock]["cpgs"]), j))
+        values.append(specs[clock]["weights"])
+    W = sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(len(cpgs), len(clocks)))
+    return {"clocks":clocks, "cpgs":cpgs, "X":imputed.fillna(0).to_numpy(dtype=float), "W":W,
+            "intercepts":np.array([specs[clock]["intercept"] for clock in clocks]),
+            "transforms":[clock_transform(*specs[clock]["transform"]) for clock in clocks]}
+
+def packed_raw_scores(pack):
+    # every linear clock's weighted sum in one sparse x dense multiply (samples x clocks) ...
+    return np.asarray(pack["W"].T.dot(pack["X"])).T + pack["intercepts"]
+
+def transform_scores(pack, raw, samples):
+    return {clock: pd.Series(np.asarray(transform(raw[:, j]), dtype=float), index=samples)
+            for j, (clock, transform) in enumerate(zip(pack["clocks"], pack["transforms"]))}
+
+@traced("predict", items=len)
+def run_clocks(mDNA, clocks=CLOCKS, model_cache=MODEL_CACHE_DIR):
     #Note for warnings for missing data (default is imputation)...
-    C = ['Horvathv1','Hannum','PhenoAge','Horvathv2','PEDBE','DunedinPACE']
-    Horvathv1_results = gallery.get("Horvathv1").predict(mDNA)
-    Hannum_results = gallery.get("Hannum").predict(mDNA)
-    PhenoAge_results = gallery.get("PhenoAge").predict(mDNA)
-    Horvathv2_results = gallery.get("Horvathv2").predict(mDNA)
-    PEDBE_results = gallery.get("PEDBE").predict(mDNA)
-    DunedinPACE_results = gallery.get("DunedinPACE").predict(mDNA)
+    specs = load_clock_specs(clocks, model_cache)
+    results = {}
+    if specs:
+        pack = pack_linear_clocks(specs, mDNA.dnam)
+        results.update(transform_scores(pack, packed_raw_scores(pack), mDNA.dnam.columns))
+    # the other clocks (e.g. DunedinPACE) run through their own biolearn model ...
+    for clock in clocks:
+        if clock not in results:
+            results[clock] = get_gallery().get(clock).predict(mDNA)["Predicted"]
     
-    print("NOTICE: Done running the clocks ...")
-    clocks_results = [Horvathv1_results,Hannum_results,PhenoAge_results,Horvathv2_results,PEDBE_results,DunedinPACE_results]
-    combined_results = pd.concat(clocks_results, axis=1)
-    combined_results.columns = C
+    notice("Done running the clocks ...")
+    combined_results = pd.concat([results[clock] for clock in clocks], axis=1)
+    combined_results.columns = clocks
+    return combined_results
+#
+@traced("predict", items=lambda baseline: len(baseline["dnam"].columns))
+def score_baseline(mDNA, clocks=CLOCKS, model_cache=MODEL_CACHE_DIR):
+    # score the original matrix once and keep what is needed to re-score perturbed cells ...
+    dnam = mDNA.dnam
+    specs = load_clock_specs(clocks, model_cache)
+    baseline = {"dnam":dnam, "clocks":clocks, "pack":None, "predictions":{}}
+    if specs:
+        pack = pack_linear_clocks(specs, dnam)
+        raw = packed_raw_scores(pack)
+        # only CpGs taken from the data respond to perturbed cells (the others come from the gold standard) ...
+        present = dnam.loc[dnam.index.intersection(pack["cpgs"])].notna()
+        kept = present.index[present.mean(axis=1) >= IMPUTATION_THRESHOLD]
+        in_data = pack["cpgs"].isin(kept).astype(float)
+        W_data = sparse.diags(in_data).dot(pack["W"]).tocsr()
+        # missing cells of those CpGs are imputed with the row mean, which moves with the perturbed cells ...
+        nan_rows = present.loc[kept][~present.loc[kept].all(axis=1)]
+        baseline.update(pack=pack, raw=raw, W_data=W_data, nan_rows=nan_rows.index,
+                        nan_mask=~nan_rows.to_numpy(), n_present=nan_rows.sum(axis=1).to_numpy())
+        baseline["predictions"].update(transform_scores(pack, raw, dnam.columns))
+    for clock in clocks:
+        if clock not in baseline["predictions"]:
+            baseline["predictions"][clock] = get_gallery().get(clock).predict(mDNA)["Predicted"]
+    notice("Done scoring the baseline matrix ...")
+    return baseline
+
+def baseline_results(baseline):
+    combined_results = pd.concat([baseline["predictions"][clock] for clock in baseline["clocks"]], axis=1)
+    combined_results.columns = baseline["clocks"]
     return combined_results
+
+@traced("predict", items=len, incremental=True)
+def rescore_clocks(baseline, cells, mDNA_new=None):
+    # update the linear clocks from the changed (CpG, sample, beta) cells only ...
+    dnam = baseline["dnam"]
+    rows = dnam.index.get_indexer(cells["CpG"])
+    cols = dnam.columns.get_indexer(cells["sample"])
+    if (rows < 0).any() or (cols < 0).any():
+        raise ValueError("Changed cells refer to CpGs or samples missing from the baseline matrix")
+    diff = cells["beta"].to_numpy() - dnam.to_numpy()[rows, cols]
+    results = {}
+    pack = baseline["pack"]
+    if pack is not None:
+        raw = baseline["raw"].copy()
+        rows = pack["cpgs"].get_indexer(cells["CpG"])
+        hit = rows >= 0  # cells outside every clock do not move the scores ...
+        np.add.at(raw, cols[hit], baseline["W_data"][rows[hit]].toarray() * diff[hit, None])
+        if len(baseline["nan_rows"]):
+            row_shift = pd.Series(diff).groupby(cells["CpG"].to_numpy()).sum()
+            mean_shift = row_shift.reindex(baseline["nan_rows"]).fillna(0).to_numpy() / baseline["n_present"]
+            W_nan = baseline["W_data"][pack["cpgs"].get_indexer(baseline["nan_rows"])].toarray()
+            raw += baseline["nan_mask"].T.dot(W_nan * mean_shift[:, None])
+        results.update(transform_scores(pack, raw, dnam.columns))
+    for clock in baseline["clocks"]:
+        if clock not in results:
+            # non-linear clocks (e.g. DunedinPACE) fall back to full scoring ...
+            if mDNA_new is None:
+                data = apply_delta(dnam, cells)
+                mDNA_new = geodata(data, dnam=data)
+            results[clock] = get_gallery().get(clock).predict(mDNA_new)["Predicted"]
+    combined_results = pd.concat([results[clock] for clock in baseline["clocks"]], axis=1)
+    combined_results.columns = baseline["clocks"]
+    return combined_results
+#
+def compact_deviation(mDNA, clocks=CLOCKS, model_cache=MODEL_CACHE_DIR):
+    # largest difference per clock between the float64 matrix and its uint16-quantized float32 copy ...
+    exact = run_clocks(mDNA, clocks, model_cache)
+    data = pd.DataFrame(dequantize_betas(quantize_betas(mDNA.dnam.to_numpy())), index=mDNA.dnam.index, columns=mDNA.dnam.columns)
+    compact = run_clocks(geodata(data, dnam=data), clocks, model_cache)
+    return (compact - exact).abs().max()
+#
+def write_predictions(combined_results, ofile):
+    # per-sample predictions with the clock names used by post-simulation_analysis.py ...
+    out = combined_results.copy()
+    out.columns = [CLOCK_LABELS.get(clock, clock) for clock in combined_results.columns]
+    out.index.name = "id"
+    with span("write", items=len(out), file=ofile):
+        out.to_csv(ofile, index=True)
+    return ofile
+#
+def prediction_inputs(beta_file, clocks, compact=False, incremental=False):
+    # what the predictions of a matrix depend on (stage_cache fingerprint); a delta file also depends on its base matrix ...
+    inputs = {"stage":"run_clocks.py", "matrix":path_digest(beta_file), "clocks":list(clocks), "compact":compact, "models":model_version(),
+              "code":code_version(sys.modules[__name__], beta_io)}
+    if beta_file.endswith(DELTA_SUFFIX):
+        inputs.update(base=path_digest(delta_base(beta_file)), incremental=incremental)
+    return inputs
+#
 if __name__ == "__main__":
-    #prepare DNAm files 
-    path = sys.argv[1]#"path_to_files/"
-    files = os.listdir(path)
-    for file in files:
-        if ".txt" in file:
-            prepare_mData(path+file)
+    path = input_dir#"path_to_files/"
+    model_cache = None if args.no_model_cache else args.model_cache
+    dtype = COMPACT_DTYPE if args.compact else np.float64
+    # only the CpG rows used by the clocks are read from the beta matrices ...
+    rows = clock_sites(args.clocks, model_cache)
     # run clocks 
     files = os.listdir(path)
     for file in files:
-        if ".prepared.txt" in file :
-            print(file)
-            mDNA = read_file(path+file)
-            combined_results = run_clocks(mDNA)
-            ofile = path+file.replace(".txt",".biolearn.csv")
-            fOut = open (ofile,'w')
-            fOut.write('Horvath,Hannum,Levine,skinHorvath,PedBE,DUNEDIN\n')# header 
-
-            combined_results.to_csv(ofile,index=False)
-            print("___________________________________________")
+        if (file.endswith(".txt") and not file.endswith(".prepared.txt")) or is_beta_store(path+file):
+            notice("Scoring {} ...".format(file))
+            ofile = beta_stem(path+file)+".biolearn.csv"
+            inputs = prediction_inputs(path+file, args.clocks, args.compact)
+            if not (args.force or args.check_precision) and is_fresh(ofile, inputs):
+                notice("{} is up to date ...".format(ofile))
+                continue
+            mDNA = read_file(path+file, rows, dtype)
+            combined_results = run_clocks(mDNA, args.clocks, model_cache)
+            if args.check_precision:
+                deviation = compact_deviation(read_file(path+file, rows), args.clocks, model_cache)
+                notice("Compact precision deviation per clock:\n{}".format(deviation.to_string()))
+                if (deviation > COMPACT_TOLERANCE).any():
+                    print("WARNING: Compact precision exceeds the tolerance of {} for {}".format(COMPACT_TOLERANCE, file))
+            record_stage(write_predictions(combined_results, ofile), inputs)
+    # run clocks on the delta files (only the changed cells are stored) ...
+    base_matrices = {}
+    baselines = {}
+    for file in files:
+        if file.endswith(DELTA_SUFFIX):
+            notice("Scoring {} ...".format(file))
+            ofile = path+file.replace(DELTA_SUFFIX,".biolearn.csv")
+            inputs = prediction_inputs(path+file, args.clocks, args.compact, args.incremental)
+            if not args.force and is_fresh(ofile, inputs):
+                notice("{} is up to date ...".format(ofile))
+                continue
+            if args.incremental:
+                # score each base matrix once, then only the changed cells of every delta file ...
+                base_file, cells = read_delta(path+file)
+                if base_file not in baselines:
+                    base = load_beta(base_file, rows, dtype)
+                    baselines[base_file] = score_baseline(geodata(base, dnam=base), args.clocks, model_cache)
+                cells = cells[cells["CpG"].isin(baselines[base_file]["dnam"].index)]
+                combined_results = rescore_clocks(baselines[base_file], cells)
+            else:
+                mDNA = read_delta_file(path+file, base_matrices, rows, dtype)
+                combined_results = run_clocks(mDNA, args.clocks, model_cache)
+            record_stage(write_predictions(combined_results, ofile), inputs)
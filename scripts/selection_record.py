@@ -0,0 +1,159 @@
+"""
+Selection Records
+-----------------
+Compact record of which beta matrix cells a simulation iteration selected
+and by how much it reduced them, stored next to the simulated outputs
+(<beta>.simulated_<tag>.<i>.selection.npz) instead of per-iteration JSON
+dicts of sample names.
+It includes:
+- A compressed file per iteration: the CpG x sample selection as a bit-packed
+  mask (one bit per cell) and the applied reduction factors of the selected
+  cells (float32, row-major, NaN where a missing beta was left unchanged)
+- Queries that read only the arrays they need: the samples hit at a CpG, the
+  CpGs hit in a sample and the reduction factors of a CpG
+- The overlap of the selections across iterations (shared cells per pair of
+  iterations, and how many iterations hit each cell)
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from instrumentation import traced
+
+SELECTION_SUFFIX = ".selection.npz"
+# set bits of every byte value ...
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+@traced("write", items=lambda path: 1)
+def write_selection_record(path, cpgs, samples, selected, factors, iteration=None):
+    """
+    Save the selection of one iteration: selected is a CpG x sample boolean array and factors the
+    multipliers applied to the cells (same shape; only the selected cells are stored).
+    """
+    selected = np.asarray(selected, dtype=bool)
+    mask = np.packbits(selected, axis=1)
+    with open(path + ".tmp", "wb") as fOut:
+        np.savez_compressed(fOut, cpgs=np.asarray(cpgs, dtype=str), samples=np.asarray(samples, dtype=str), mask=mask,
+                            n_samples=selected.shape[1], factors=np.asarray(factors, dtype=np.float32)[selected],
+                            row_offsets=np.concatenate([[0], np.cumsum(selected.sum(axis=1))]),
+                            iteration=-1 if iteration is None else iteration)
+    os.replace(path + ".tmp", path)
+    return path
+
+class SelectionRecord:
+    """
+    Read access to a selection record; each array is read from the file on first use only.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = np.load(path)
+        self._arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = self._file[name]
+        return self._arrays[name]
+
+    @property
+    def cpgs(self):
+        return pd.Index(self._array("cpgs"), name="CpG")
+
+    @property
+    def samples(self):
+        return pd.Index(self._array("samples"))
+
+    @property
+    def iteration(self):
+        iteration = int(self._array("iteration"))
+        return None if iteration < 0 else iteration
+
+    def _row(self, cpg):
+        rows = self.cpgs.get_indexer([cpg])
+        return None if rows[0] < 0 else rows[0]
+
+    def selected(self):
+        """
+        The whole selection as a CpG x sample boolean DataFrame.
+        """
+        mask = np.unpackbits(self._array("mask"), axis=1, count=int(self._array("n_samples"))).astype(bool)
+        return pd.DataFrame(mask, index=self.cpgs, columns=self.samples)
+
+    def samples_at(self, cpg):
+        """
+        Samples selected at a CpG (empty for a CpG outside the record).
+        """
+        row = self._row(cpg)
+        if row is None:
+            return []
+        hits = np.unpackbits(self._array("mask")[row], count=int(self._array("n_samples"))).astype(bool)
+        return list(self.samples[hits])
+
+    def cpgs_in(self, sample):
+        """
+        CpGs selected in a sample (empty for a sample outside the record).
+        """
+        column = self.samples.get_indexer([sample])[0]
+        if column < 0:
+            return []
+        hits = (self._array("mask")[:, column // 8] >> (7 - column % 8)) & 1
+        return list(self.cpgs[hits.astype(bool)])
+
+    def factors_at(self, cpg):
+        """
+        Reduction factors applied at a CpG, by selected sample (NaN where the beta was missing).
+        """
+        row = self._row(cpg)
+        if row is None:
+            return pd.Series(dtype=np.float32)
+        start, end = self._array("row_offsets")[row:row + 2]
+        return pd.Series(self._array("factors")[start:end], index=self.samples_at(cpg))
+
+def open_selection_record(path):
+    return SelectionRecord(path)
+
+def _aligned_mask(record, cpgs, samples):
+    # packed mask in the given CpG and sample order (records of the same run share it already) ...
+    if record.cpgs.equals(cpgs) and record.samples.equals(samples):
+        return record._array("mask")
+    selected = record.selected().reindex(index=cpgs, columns=samples, fill_value=False)
+    return np.packbits(selected.to_numpy(dtype=bool), axis=1)
+
+def iteration_overlap(paths):
+    """
+    Cells selected in both of every pair of iterations (diagonal: cells selected in the iteration),
+    computed on the packed masks.
+    """
+    records = [open_selection_record(path) for path in paths]
+    try:
+        cpgs, samples = records[0].cpgs, records[0].samples
+        masks = [_aligned_mask(record, cpgs, samples) for record in records]
+        overlap = np.zeros((len(masks), len(masks)), dtype=np.int64)
+        for a in range(len(masks)):
+            for b in range(a, len(masks)):
+                overlap[a, b] = overlap[b, a] = POPCOUNT[masks[a] & masks[b]].sum(dtype=np.int64)
+        labels = [record.iteration if record.iteration is not None else os.path.basename(record.path) for record in records]
+    finally:
+        for record in records:
+            record.close()
+    return pd.DataFrame(overlap, index=labels, columns=labels)
+
+def hit_counts(paths):
+    """
+    Number of iterations that selected each cell, as a CpG x sample DataFrame.
+    """
+    counts = None
+    for path in paths:
+        with open_selection_record(path) as record:
+            selected = record.selected()
+        counts = selected.astype(np.uint16) if counts is None else counts.add(selected.astype(np.uint16), fill_value=0).astype(np.uint16)
+    return counts
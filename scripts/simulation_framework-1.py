@@ -3,7 +3,13 @@ import os, sys
 import argparse
 import pandas as pd
 import numpy as np
-import json
+from beta_io import BETA_STORE_SUFFIX, COMPACT_DTYPE, DELTA_SUFFIX, beta_stem, is_beta_store, load_beta, write_beta_store, write_delta
+from variant_index import load_variant_index, population_from_filename
+from simulation_runtime import iteration_stream, run_iterations, worker_state, open_checkpoint, pending_iterations, checkpoint_iteration
+from stage_cache import code_version, path_digest, population_digest, stage_fingerprint
+from selection_record import SELECTION_SUFFIX, write_selection_record
+from instrumentation import add_arguments, configure_from_args, notice, span, traced, verbosity
+import beta_io, selection_record, simulation_runtime, variant_index
 
 def validate_file(path):
     if not os.path.isfile(path):
@@ -15,15 +21,33 @@ def validate_directory(path):
         raise argparse.ArgumentTypeError(f"Directory not found: {path}")
     return path
 
+def validate_beta_path(path):
+    if not (os.path.isfile(path) or is_beta_store(path)):
+        raise argparse.ArgumentTypeError(f"Beta matrix file or store not found: {path}")
+    return path
+
+def validate_intersected_data(path):
+    if not (os.path.isdir(path) or os.path.isfile(path)):
+        raise argparse.ArgumentTypeError(f"Intersected data directory or variant index not found: {path}")
+    return path
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Run the simulation framework using mutation data and beta matrix.")
     parser.add_argument("mutation_file", type=validate_file, help="Mutation file: [population].common_mutations_in_CpG.with_zygosity.txt")
-    parser.add_argument("intersected_data_dir", type=validate_directory, help="Directory containing intersected mutation data")
-    parser.add_argument("beta_file", type=validate_file, help="DNA methylation beta matrix file (TSV format)")
+    parser.add_argument("intersected_data_dir", type=validate_intersected_data, help="Directory containing intersected mutation data, or a compiled variant index")
+    parser.add_argument("beta_file", type=validate_beta_path, help="DNA methylation beta matrix file (TSV format) or beta store directory")
+    parser.add_argument("--iterations", type=int, default=10, help="Number of simulation iterations (default: 10)")
+    parser.add_argument("--output-format", choices=["full", "delta"], default="full", help="Write full beta matrix copies or only the changed cells (default: full)")
+    parser.add_argument("--compact", action="store_true", help="Hold betas as float32 and write full outputs as uint16-quantized beta stores")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for the iterations (default: 1)")
+    parser.add_argument("--seed", type=int, default=None, help="Master random seed; each iteration gets its own stream spawned from it")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from its checkpoint, skipping the completed iterations")
+    add_arguments(parser)
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_arguments()
+    configure_from_args(args)
 
     # These will be passed to the function logic
     mutation_file = args.mutation_file
@@ -31,6 +55,7 @@ if __name__ == "__main__":
     beta_file = args.beta_file
 
 
+@traced("parse", items=lambda result: len(result[1]))
 def read_mutations_file(mutation_file):
     file_name = mutation_file.split("/")
     file_name2 = file_name[-1].split(".")
@@ -64,30 +89,41 @@ def read_mutations_file(mutation_file):
 
     return data, zygosity_df
 #
+@traced("index_build", items=lambda result: len(result[1]))
 def process_intersected_data(path_intersected_data, data):
+    # read the variant -> CpG -> clock links from the compiled variant index (or the intersected data directory) ...
+    variants = load_variant_index(path_intersected_data).variants()
     cpgs =[]  # also create cpgs list for tracking ...
-    files = os.listdir(path_intersected_data)
-    for file in files:
-        fH = open (path_intersected_data + file,'r')
-        lines = fH.readlines()
-        file_name = file.split('.')
-        population = file_name[-4]
-        if population in data:
-            for line in lines:
-                tokens = line.replace("\n","").split(",")
-                CpG_mutations = tokens[-1].split(";")
-                for CpG_mutation in CpG_mutations:
-                    if CpG_mutation in data[population]:
-                        data[population][CpG_mutation]["CpG"] = tokens[2]
-                        data[population][CpG_mutation]["clock"].append(tokens[1])
-                        cpgs.append(tokens[2])
+    for population, variant, cpg, clock in variants[["population","variant","CpG","clock"]].itertuples(index=False):
+        if population in data and variant in data[population]:
+            data[population][variant]["CpG"] = cpg
+            data[population][variant]["clock"].append(clock)
+            cpgs.append(cpg)
     selected_per_cpg = {cpg: set() for cpg in cpgs}
     return data , selected_per_cpg
 #
-def read_DNAm_dataset(DNAm_dataset,data, zygosity_df,i,selected_per_cpg):
-    # read data ...
-    df = pd.read_csv(DNAm_dataset, index_col =0,sep = '\t')
-    print('NOTICE: Done reading DNAm file...')
+def draw_perturbations(af, is_het, n_columns, n_samples, rng):
+    # determine the selected sample size by AF (minimum of 5 for low allele frequency) ...
+    sample_sizes = np.maximum((af * n_columns).astype(int), 5)
+    # draw samples (with replacement) for every CpG at once, duplicates collapse in the mask ...
+    rows = np.repeat(np.arange(len(af)), sample_sizes)
+    selected = np.zeros((len(af), n_samples), dtype=bool)
+    selected[rows, rng.integers(0, n_samples, size=rows.size)] = True
+    # Heterozygous case: reduce by 0%-50%, Homozygous case: reduce by 60%-100% ...
+    low = np.where(is_het, 0.0, 0.6)[:, None]
+    width = np.where(is_het, 0.5, 0.4)[:, None]
+    percentage_to_change = low + width * rng.random(selected.shape)
+    return selected, 1.0 - percentage_to_change, sample_sizes
+#
+@traced("parse", items=len)
+def load_DNAm_dataset(DNAm_dataset, cpgs=None, compact=False):
+    # read data (once for all the simulation iterations), only the rows of cpgs when given ...
+    df = load_beta(DNAm_dataset, cpgs, dtype=COMPACT_DTYPE if compact else np.float64)
+    notice('Done reading DNAm file...')
+    return df
+#
+@traced("index_build", items=lambda result: len(result[0]))
+def build_CpG_maps(data, zygosity_df):
     # generate a list of the CpG overlap with a genetic variant and 
     # dictionary to map overlapping CpG to the genetic variant zygosity...
     # dictionary to map overlapping CpG to the Normalized_Probability...
@@ -96,7 +132,7 @@ def read_DNAm_dataset(DNAm_dataset,data, zygosity_df,i,selected_per_cpg):
     CpG_to_Normalized_Probability = {}
     CpG_to_af  ={}
     for population in data:
-        print(population)
+        notice(population, level=2)
         for variant in data[population]:
             CpG_overlap_with_G.append(data[population][variant]["CpG"])
             CpG_to_Zygosity[data[population][variant]["CpG"]] = data[population][variant]["zygosity"]
@@ -113,78 +149,115 @@ def read_DNAm_dataset(DNAm_dataset,data, zygosity_df,i,selected_per_cpg):
 
     if len(list(set(CpG_overlap_with_G))) < len(CpG_overlap_with_G):
         print("WARNING: Please check the CpGs for duplicates!")
-    CpG_overlap_with_G = list(set(CpG_overlap_with_G))
-    track = {}
-    for cpg in CpG_overlap_with_G:
-        track[cpg] = []
+    CpG_overlap_with_G = sorted(set(CpG_overlap_with_G)) # fixed order for reproducible random streams ...
+    return CpG_overlap_with_G, CpG_to_Zygosity, CpG_to_af
+#
+def read_DNAm_dataset(DNAm_dataset,df,CpG_maps,i,selected_per_cpg,rng=None,output_format="full",compact=False,selection_file=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    CpG_overlap_with_G, CpG_to_Zygosity, CpG_to_af = CpG_maps
     # create simulated dataset ...
     df_new = df.copy() # create a copy ...
-    # Create a DataFrame to track which samples have been selected for each CpG
-    tracking_df = pd.DataFrame(index=CpG_overlap_with_G, columns=df.columns[1:])  # Exclude 'ID_REF' column
-    tracking_df[:] = False  # Initialize tracking DataFrame with False (no samples selected yet)
-    
-    # Loop over each CpG
-    for cpg in CpG_overlap_with_G:
-        available_samples = list(df.columns[1:])  # Get the sample column names
-        # determine the selected sample size by AF ...
-        sample_size =  {sample: set() for sample in df.columns}
-        n = int(float(CpG_to_af[cpg]) * len(sample_size))
-        if n < 5:#in case of low allele frequency ....
-            n = 5 # minimum number of selected samples ...
-        print('NOTICE: For {} {} {} will be selected'.format(cpg,n,float(CpG_to_af[cpg])))
-        # Randomly select n samples from available samples for this CpG in this iteration
-        selected_samples = np.random.choice(available_samples,n)
-        # Mark the selected samples in the tracking DataFrame to avoid re-selection
-        # check for duplication in the selected samples
-        if len(selected_samples) != len(list(set(selected_samples))):
-            selected_samples = list(set(selected_samples))
-        tracking_df.loc[cpg, selected_samples] = True  
-        # Remove selected samples from available samples for subsequent iterations
-        available_samples = [sample for sample in available_samples if sample not in selected_samples]
-
-        # Apply changes to the beta values based on zygosity
-        for sample in selected_samples:
-            # Check if CpG is present in the DataFrame
-            if cpg in df_new.index:
-                beta = df_new.at[cpg, sample]  # Get the current beta value
-                track[cpg].append(sample)
-                
-                # Check zygosity and apply changes
-                if beta >= 0:#0.3:  # Proceed only if beta value is greater than 0.3
-                    if CpG_to_Zygosity.get(cpg) == "het":
-                        # Heterozygous case: reduce by a percentage between 0% and 50%
-                        percentage_to_change = np.random.uniform(0.0, 0.5)
-                    else:  # Homozygous case: reduce by a percentage between 60% and 100%
-                        percentage_to_change = np.random.uniform(0.6, 1.0)
-                    
-                    change = beta * percentage_to_change
-                    new_beta = beta - change
-                    
-                    # If new beta is negative, print a warning and exit
-                    if new_beta < 0:
-                        print(f"WARNING: Beta value is negative for {cpg} in sample {sample}: {new_beta}")
-                        exit(0)
-                    
-                    # Update the beta value in the DataFrame
-                    df_new.at[cpg, sample] = new_beta
-    
-    outfile = DNAm_dataset.replace('.txt','.simulated_iv5.{}.txt'.format(i))
-    df_new.to_csv(outfile, sep='\t', index=True)
-    # Verify the file creation
-    print("NOTICE: DONE simulation {} ...".format(i))
-    with open("track.simulation_i.{}.json".format(i), "w") as outfile: 
-        json.dump(track, outfile)
-    return
+    samples = df.columns[1:]  # Exclude 'ID_REF' column
+    af = np.array([float(CpG_to_af[cpg]) for cpg in CpG_overlap_with_G])
+    is_het = np.array([CpG_to_Zygosity.get(cpg) == "het" for cpg in CpG_overlap_with_G])
+    # draw all the selections and reduction factors in one shot ...
+    with span("selection", iteration=i) as record:
+        selected, factors, sample_sizes = draw_perturbations(af, is_het, len(df.columns), len(samples), rng)
+        record["items"] = int(selected.sum())
+    if verbosity() >= 2: # one message per CpG, only when asked for (-v) ...
+        for cpg, n in zip(CpG_overlap_with_G, sample_sizes):
+            notice('For {} {} {} will be selected'.format(cpg,n,float(CpG_to_af[cpg])), level=2)
+    # only CpGs present in the array can be changed ...
+    in_array = np.array([cpg in df_new.index for cpg in CpG_overlap_with_G], dtype=bool)
+    rows = [cpg for cpg, found in zip(CpG_overlap_with_G, in_array) if found]
+    selected, factors = selected[in_array], factors[in_array]
+    # Apply changes to the beta values based on zygosity (single vectorized multiply)
+    with span("perturbation", iteration=i) as record:
+        beta = df_new.loc[rows, samples].to_numpy()
+        change = selected & (beta >= 0)
+        df_new.loc[rows, samples] = np.where(change, beta * factors, beta).astype(beta.dtype)
+        record["items"] = int(change.sum())
 
+    if selection_file is not None:
+        # selected cells and the factors applied to them (NaN where a missing beta was left unchanged) ...
+        write_selection_record(selection_file, rows, samples, selected, np.where(change, factors, np.nan), i)
+    write_simulated(DNAm_dataset, df, df_new, CpG_overlap_with_G, i, output_format, compact)
+    notice("DONE simulation {} ...".format(i))
+    return df_new
+#
+@traced("write", items=lambda outfile: int(outfile is not None))
+def write_simulated(DNAm_dataset, df, df_new, CpG_overlap_with_G, i, output_format="full", compact=False):
+    # write the simulated matrix of iteration i (nothing when it is only used in memory) ...
+    outfile = None
+    if output_format == "delta":
+        # only store the changed cells next to a reference to the base matrix ...
+        outfile = simulated_file(DNAm_dataset, i, output_format)
+        touched = df.index.intersection(CpG_overlap_with_G)
+        write_delta(outfile, DNAm_dataset, df.loc[touched], df_new.loc[touched])
+    elif output_format == "full" and compact:
+        # uint16-quantized store instead of decimal text ...
+        outfile = simulated_file(DNAm_dataset, i, output_format, compact)
+        write_beta_store(outfile, df_new, compact=True)
+    elif output_format == "full":
+        outfile = simulated_file(DNAm_dataset, i, output_format)
+        df_new.to_csv(outfile, sep='\t', index=True)
+    return outfile
+#
+def simulated_file(DNAm_dataset, i, output_format="full", compact=False):
+    # output of iteration i: a delta file, a uint16-quantized beta store or a TSV ...
+    suffix = DELTA_SUFFIX if output_format == "delta" else BETA_STORE_SUFFIX if compact else ".txt"
+    return beta_stem(DNAm_dataset)+'.simulated_iv5.{}{}'.format(i, suffix)
+#
+def selection_file(DNAm_dataset, i):
+    # selection record of iteration i, next to its output ...
+    return beta_stem(DNAm_dataset)+'.simulated_iv5.{}{}'.format(i, SELECTION_SUFFIX)
+#
+def simulation_inputs(mutation_file, intersected_data_dir, DNAm_dataset, output_format="full", compact=False):
+    # what the simulated outputs depend on besides the seed; only this population's intersected rows count ...
+    return {"stage":os.path.basename(__file__), "beta":path_digest(DNAm_dataset), "mutations":path_digest(mutation_file),
+            "intersected_data":population_digest(intersected_data_dir, population_from_filename(mutation_file)),
+            "output_format":output_format, "compact":compact,
+            "code":code_version(sys.modules[__name__], beta_io, simulation_runtime, variant_index, selection_record)}
+#
+def simulate_iteration(i):
+    # run one simulation iteration on the shared beta matrix with its own random stream ...
+    state = worker_state()
+    return read_DNAm_dataset(state["DNAm_dataset"],state["df"],state["CpG_maps"],i,state["selected_per_cpg"],
+                             rng=iteration_stream(state["entropy"], i),output_format=state["output_format"],compact=state.get("compact", False),
+                             selection_file=state["selection_file"].format(i) if state.get("selection_file") else None)
+#
+def run_iteration(i):
+    # write iteration i and return only its output path (None in memory), so no matrix goes back to the parent ...
+    simulate_iteration(i)
+    state = worker_state()
+    output_format = state["output_format"]
+    return simulated_file(state["DNAm_dataset"], i, output_format, state.get("compact", False)) if output_format is not None else None
 #
 
 if __name__ == "__main__":
-    data, zygosity_df = read_mutations_file(sys.argv[1])
+    data, zygosity_df = read_mutations_file(mutation_file)
     # add the clock information ... 
-    updated_data, selected_per_cpg = process_intersected_data(sys.argv[2],data)
-    print('NOTICE: Tracker is created ...')
-    # generate simulated dataset ...
-    for i in range (10): # set simulations iterations # 10 ...
-        read_DNAm_dataset(sys.argv[3],data,zygosity_df, i,selected_per_cpg)
- 
-
+    updated_data, selected_per_cpg = process_intersected_data(intersected_data_dir,data)
+    notice('Tracker is created ...')
+    # read the beta matrix and build the CpG lookups once ...
+    CpG_maps = build_CpG_maps(data, zygosity_df)
+    # the checkpoint keeps the master seed, the completed iterations (--resume) and the fingerprint of the inputs:
+    # a seeded rerun with unchanged inputs reuses the outputs that exist ...
+    checkpoint_file = beta_stem(beta_file)+'.simulated_iv5.checkpoint.json'
+    inputs = simulation_inputs(mutation_file, intersected_data_dir, beta_file, args.output_format, args.compact)
+    checkpoint = open_checkpoint(checkpoint_file, args.seed, args.resume, stage_fingerprint(inputs))
+    entropy = checkpoint["entropy"]
+    notice('Master seed {} ...'.format(entropy))
+    pending = pending_iterations(checkpoint, args.iterations, lambda i: simulated_file(beta_file, i, args.output_format, args.compact))
+    if not pending:
+        notice('All {} simulations are up to date ...'.format(args.iterations))
+        sys.exit(0)
+    # delta files only need the overlapping CpG rows (the clocks read the rest from the base matrix) ...
+    df = load_DNAm_dataset(beta_file, CpG_maps[0] if args.output_format == "delta" else None, args.compact)
+    # generate simulated dataset (set simulations iterations) ...
+    context = {"DNAm_dataset":beta_file, "CpG_maps":CpG_maps, "selected_per_cpg":selected_per_cpg,
+               "entropy":entropy, "output_format":args.output_format, "compact":args.compact,
+               "selection_file":selection_file(beta_file, "{}")}  # filled in per iteration ...
+    run_iterations(run_iteration, pending, df, context, workers=args.workers,
+                   on_done=checkpoint_iteration(checkpoint_file, checkpoint))
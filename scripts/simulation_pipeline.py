@@ -0,0 +1,186 @@
+"""
+Simulation -> Clock Prediction Pipeline
+---------------------------------------
+Runs simulation framework I or II and scores every simulated beta matrix with
+the epigenetic clocks in memory: the perturbed matrix is handed from
+read_DNAm_dataset straight to run_clocks.run_clocks, so no simulated TSV,
+.prepared.txt or delta file is written. Only the per-sample clock predictions
+are saved. Only the CpG rows used by the simulation and the clocks are loaded.
+A seeded rerun with unchanged inputs (beta matrix, mutation file, this
+population's intersected data, clocks and code) reuses the predictions that exist:
+- <outdir>/<beta>.original.biolearn.csv          (unperturbed matrix)
+- <outdir>/simulated/<beta>.simulated_<tag>.<i>.biolearn.csv
+- <outdir>/selection/<beta>.simulated_<tag>.<i>.selection.npz  (selected cells, see selection_record.py)
+
+The original predictions and the simulated/ directory can be passed directly to
+post-simulation_analysis.py.
+"""
+
+import os, sys
+import argparse
+import importlib.util
+from beta_io import beta_stem, changed_cells, is_beta_store
+from run_clocks import CLOCKS, clock_sites, geodata, run_clocks, write_predictions, score_baseline, baseline_results, rescore_clocks, model_version
+from simulation_runtime import master_entropy, run_iterations, worker_state, open_checkpoint, pending_iterations, checkpoint_iteration
+from stage_cache import code_version, path_digest, stage_fingerprint, is_fresh, record_stage
+from instrumentation import add_arguments, configure_from_args, notice
+from selection_record import SELECTION_SUFFIX
+import beta_io, run_clocks as run_clocks_module
+
+FRAMEWORK_TAGS = {1: "iv5", 2: "ii"}
+
+# clock scores of the original matrix, computed once per process for --incremental ...
+_baseline = {}
+
+def validate_file(path):
+    if not os.path.isfile(path):
+        raise argparse.ArgumentTypeError(f"File not found: {path}")
+    return path
+
+def validate_directory(path):
+    if not os.path.isdir(path):
+        raise argparse.ArgumentTypeError(f"Directory not found: {path}")
+    return path
+
+def validate_beta_path(path):
+    if not (os.path.isfile(path) or is_beta_store(path)):
+        raise argparse.ArgumentTypeError(f"Beta matrix file or store not found: {path}")
+    return path
+
+def validate_intersected_data(path):
+    if not (os.path.isdir(path) or os.path.isfile(path)):
+        raise argparse.ArgumentTypeError(f"Intersected data directory or variant index not found: {path}")
+    return path
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Simulate perturbed beta matrices and predict the clocks in memory.")
+    parser.add_argument("mutation_file", type=validate_file, help="Mutation file: [population].with_zygosity.txt")
+    parser.add_argument("intersected_data_dir", type=validate_intersected_data, help="Directory containing intersected mutation data, or a compiled variant index")
+    parser.add_argument("beta_file", type=validate_beta_path, help="DNA methylation beta matrix file (TSV format) or beta store directory")
+    parser.add_argument("--framework", type=int, choices=[1, 2], default=1, help="Simulation framework to run (default: 1)")
+    parser.add_argument("--iterations", type=int, default=10, help="Number of simulation iterations (default: 10)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for the iterations (default: 1)")
+    parser.add_argument("--seed", type=int, default=None, help="Master random seed; each iteration gets its own stream spawned from it")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from its checkpoint in --outdir, skipping the completed iterations")
+    parser.add_argument("--clocks", nargs="+", default=CLOCKS, help="biolearn clock names to run (default: %(default)s)")
+    parser.add_argument("--incremental", action="store_true", help="Score the original matrix once and re-score each simulation from its changed cells")
+    parser.add_argument("--compact", action="store_true", help="Hold the beta matrix as float32 instead of float64")
+    parser.add_argument("--outdir", default="predictions", help="Output directory for the clock predictions (default: predictions)")
+    add_arguments(parser)
+    return parser.parse_args()
+
+def load_framework(framework):
+    # the framework scripts have '-' in their names, so load them from their path ...
+    name = "simulation_framework_{}".format(framework)
+    if name not in sys.modules:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simulation_framework-{}.py".format(framework))
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+def prepare_simulation(framework, mutation_file, intersected_data_dir, beta_file, iterations, seed=None, clocks=None, compact=False,
+                       checkpoint_file=None, resume=False, df=None, fingerprint=None):
+    # read the inputs once and build the per-run context shared by all the iterations ...
+    # with clocks, only the overlapping CpGs and the CpGs read by those clocks are loaded ...
+    # an already loaded beta matrix (df, holding at least those rows) is used as is ...
+    # with checkpoint_file, the master seed (and the framework II tracker) come from the checkpoint ...
+    fw = load_framework(framework)
+    data, zygosity_df = fw.read_mutations_file(mutation_file)
+    checkpoint = open_checkpoint(checkpoint_file, seed, resume, fingerprint) if checkpoint_file else {"entropy":master_entropy(seed), "completed":[]}
+    entropy = checkpoint["entropy"]
+    notice('Master seed {} ...'.format(entropy))
+    context = {"framework":framework, "DNAm_dataset":beta_file, "entropy":entropy, "output_format":None, "checkpoint":checkpoint}
+    if framework == 1:
+        data, context["selected_per_cpg"] = fw.process_intersected_data(intersected_data_dir, data)
+    else:
+        data = fw.process_intersected_data(intersected_data_dir, data)
+    context["CpG_maps"] = fw.build_CpG_maps(data, zygosity_df)
+    if df is None:
+        rows = clock_sites(clocks) if clocks is not None else None
+        df = fw.load_DNAm_dataset(beta_file, sorted(set(rows) | set(context["CpG_maps"][0])) if rows is not None else None, compact)
+    if framework == 2:
+        # the exclusion tracker is sequential, so draw the selections of all iterations in order first ...
+        available = fw.develope_tracker(df, context["CpG_maps"][0])
+        n = fw.selection_size(data, len(df.columns))
+        tracker_file = checkpoint_file.replace(".json", ".tracker.npz") if checkpoint_file else None
+        context["selections"] = fw.draw_selections(context["CpG_maps"][0], df.columns, available, n, entropy, iterations, tracker_file,
+                                                   resume or bool(checkpoint["completed"]), checkpoint.get("fingerprint"))
+    return df, context
+
+def pipeline_inputs(framework, mutation_file, intersected_data_dir, beta_file, clocks, compact=False, incremental=False):
+    # what the predictions depend on besides the seed (stage_cache fingerprint) ...
+    inputs = load_framework(framework).simulation_inputs(mutation_file, intersected_data_dir, beta_file, None, compact)
+    inputs.update(stage="simulation_pipeline.py", framework=framework, clocks=list(clocks), incremental=incremental, models=model_version(),
+                  pipeline_code=code_version(sys.modules[__name__], run_clocks_module))
+    return inputs
+
+def original_inputs(beta_file, clocks, compact=False, incremental=False):
+    return {"stage":"original predictions", "beta":path_digest(beta_file), "clocks":list(clocks), "compact":compact, "incremental":incremental,
+            "models":model_version(), "code":code_version(sys.modules[__name__], run_clocks_module, beta_io)}
+
+def simulated_predictions(outdir, beta_file, framework, i):
+    stem = os.path.basename(beta_stem(beta_file))
+    return os.path.join(outdir, "simulated", "{}.simulated_{}.{}.biolearn.csv".format(stem, FRAMEWORK_TAGS[framework], i))
+
+def simulated_selection(outdir, beta_file, framework, i):
+    stem = os.path.basename(beta_stem(beta_file))
+    # kept apart from the predictions, so simulated/ only holds the input of post-simulation_analysis.py ...
+    return os.path.join(outdir, "selection", "{}.simulated_{}.{}{}".format(stem, FRAMEWORK_TAGS[framework], i, SELECTION_SUFFIX))
+
+def clock_baseline(df, clocks):
+    if "scores" not in _baseline:
+        _baseline["scores"] = score_baseline(geodata(dnam=df), clocks)
+    return _baseline["scores"]
+
+def predict_iteration(i):
+    # simulate iteration i and score the perturbed matrix without writing it ...
+    state = worker_state()
+    fw = load_framework(state["framework"])
+    df_new = fw.simulate_iteration(i)
+    if state["incremental"]:
+        # linear clocks are updated from the perturbed cells, the others are re-scored in full ...
+        df = state["df"]
+        touched = df.index.intersection(state["CpG_maps"][0])
+        cells = changed_cells(df.loc[touched], df_new.loc[touched])
+        combined_results = rescore_clocks(clock_baseline(df, state["clocks"]), cells, geodata(dnam=df_new))
+    else:
+        combined_results = run_clocks(geodata(dnam=df_new), state["clocks"])
+    return write_predictions(combined_results, simulated_predictions(state["outdir"], state["DNAm_dataset"], state["framework"], i))
+
+def run_pipeline(framework, mutation_file, intersected_data_dir, beta_file, iterations=10, workers=1, seed=None, outdir="predictions", incremental=False, clocks=CLOCKS, compact=False,
+                 resume=False, df=None):
+    os.makedirs(os.path.join(outdir, "simulated"), exist_ok=True)
+    os.makedirs(os.path.join(outdir, "selection"), exist_ok=True)
+    stem = os.path.basename(beta_stem(beta_file))
+    checkpoint_file = os.path.join(outdir, "{}.simulated_{}.checkpoint.json".format(stem, FRAMEWORK_TAGS[framework]))
+    fingerprint = stage_fingerprint(pipeline_inputs(framework, mutation_file, intersected_data_dir, beta_file, clocks, compact, incremental))
+    df, context = prepare_simulation(framework, mutation_file, intersected_data_dir, beta_file, iterations, seed, clocks, compact,
+                                     checkpoint_file, resume, df, fingerprint)
+    context["outdir"] = outdir
+    context["incremental"] = incremental
+    context["clocks"] = clocks
+    context["selection_file"] = simulated_selection(outdir, beta_file, framework, "{}")  # filled in per iteration ...
+    # score the original matrix once (unless its predictions are up to date) ...
+    original_file = os.path.join(outdir, "{}.original.biolearn.csv".format(stem))
+    inputs = original_inputs(beta_file, clocks, compact, incremental)
+    if is_fresh(original_file, inputs):
+        notice("The original predictions are up to date ...")
+    else:
+        original_results = baseline_results(clock_baseline(df, clocks)) if incremental else run_clocks(geodata(dnam=df), clocks)
+        record_stage(write_predictions(original_results, original_file), inputs)
+        notice("Done predicting the original matrix ...")
+    checkpoint = context.pop("checkpoint")
+    simulated_files = [simulated_predictions(outdir, beta_file, framework, i) for i in range(iterations)]
+    pending = pending_iterations(checkpoint, iterations, lambda i: simulated_files[i])
+    run_iterations(predict_iteration, pending, df, context, workers=workers, on_done=checkpoint_iteration(checkpoint_file, checkpoint))
+    notice("Done predicting {} simulations ({} up to date) ...".format(len(pending), iterations - len(pending)))
+    return original_file, simulated_files
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    configure_from_args(args)
+    run_pipeline(args.framework, args.mutation_file, args.intersected_data_dir, args.beta_file,
+                 iterations=args.iterations, workers=args.workers, seed=args.seed, outdir=args.outdir,
+                 incremental=args.incremental, clocks=args.clocks, compact=args.compact, resume=args.resume)
@@ -0,0 +1,154 @@
+"""
+Simulation Runtime
+------------------
+Helpers used by the simulation frameworks to run iterations in parallel.
+It includes:
+- Per-iteration random streams derived from a single master seed, so the
+  results do not depend on the number of workers
+- Sharing the beta matrix read-only with the worker processes (shared memory
+  instead of pickling the matrix to every worker)
+- A process-pool runner that returns the results in iteration order
+- Checkpoints (master seed, completed iterations and the fingerprint of the
+  run inputs) so an interrupted run can be resumed with the same random
+  streams, and a seeded run whose inputs did not change reuses its outputs
+
+"""
+
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from instrumentation import notice
+
+# state of the current process (the beta matrix and the per-run context) ...
+_worker_state = {}
+
+def master_entropy(seed=None):
+    """
+    Return the master seed entropy (a fresh one is drawn when no seed is given).
+    """
+    return np.random.SeedSequence(seed).entropy
+
+def iteration_stream(entropy, i, stream=0):
+    """
+    Independent random generator for iteration i (stream allows several generators per iteration).
+    """
+    return np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(i, stream)))
+
+class SharedBetaMatrix:
+    """
+    Copy of the beta matrix values in shared memory that workers attach to read-only.
+    """
+    def __init__(self, df):
+        values = np.ascontiguousarray(df.to_numpy())
+        self.shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=self.shm.buf)[:] = values
+        self.spec = (self.shm.name, values.shape, values.dtype.str, list(df.index), list(df.columns), df.index.name)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+def attach_beta_matrix(spec):
+    name, shape, dtype, index, columns, index_name = spec
+    shm = shared_memory.SharedMemory(name=name)
+    values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    values.flags.writeable = False
+    df = pd.DataFrame(values, index=pd.Index(index, name=index_name), columns=columns, copy=False)
+    return shm, df
+
+def _init_worker(spec, context):
+    shm, df = attach_beta_matrix(spec)
+    _worker_state.clear()
+    _worker_state.update(context, df=df, shm=shm)
+
+def worker_state():
+    """
+    The beta matrix ('df') and the run context of the current process.
+    """
+    return _worker_state
+
+def run_iterations(worker, iterations, df, context, workers=1, on_done=None, keep_results=False):
+    """
+    Run worker(i) for every iteration, in-process or on a pool of worker processes.
+    on_done(i, result) is called in this process as soon as iteration i has finished; the results are
+    only kept (and returned in iteration order) with keep_results, otherwise each is dropped after on_done.
+    """
+    iterations = list(iterations)
+    results = {}
+    if workers <= 1 or len(iterations) <= 1:
+        _worker_state.clear()
+        _worker_state.update(context, df=df)
+        for i in iterations:
+            result = worker(i)
+            if on_done is not None:
+                on_done(i, result)
+            if keep_results:
+                results[i] = result
+        return [results[i] for i in iterations] if keep_results else None
+    shared = SharedBetaMatrix(df)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared.spec, context)) as pool:
+            futures = {pool.submit(worker, i): i for i in iterations}
+            for future in as_completed(futures):
+                # a finished future is released here, so its result is not held until the end of the run ...
+                i = futures.pop(future)
+                if on_done is not None:
+                    on_done(i, future.result())
+                if keep_results:
+                    results[i] = future.result()
+            return [results[i] for i in iterations] if keep_results else None
+    finally:
+        shared.close()
+
+def save_checkpoint(checkpoint_file, state):
+    """
+    Write the checkpoint atomically, so a run killed while saving keeps the previous one.
+    """
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "w") as fOut:
+        json.dump(state, fOut)
+    os.replace(tmp_file, checkpoint_file)
+
+def open_checkpoint(checkpoint_file, seed=None, resume=False, fingerprint=None):
+    """
+    Checkpoint state of a run: the master seed entropy (from which every iteration stream is spawned),
+    the completed iterations and the fingerprint of the run inputs (stage_cache.stage_fingerprint, without the seed).
+    The saved state is reloaded with resume, or without it for a seeded run with the same fingerprint
+    (its outputs are reused); a checkpoint of other inputs starts a new run.
+    """
+    if os.path.isfile(checkpoint_file) and (resume or (seed is not None and fingerprint is not None)):
+        with open(checkpoint_file, "r") as fH:
+            state = json.load(fH)
+        saved = state.get("fingerprint")
+        if fingerprint is not None and saved != fingerprint and (saved is not None or not resume):
+            notice("The inputs changed since {}, starting a new run ...".format(checkpoint_file))
+        elif not resume and state["entropy"] != master_entropy(seed):
+            notice("{} has another seed, starting a new run ...".format(checkpoint_file))
+        else:
+            notice("Resuming from {} ({} iterations done) ...".format(checkpoint_file, len(state["completed"])))
+            state["fingerprint"] = fingerprint
+            return state
+    state = {"entropy": master_entropy(seed), "completed": [], "fingerprint": fingerprint}
+    save_checkpoint(checkpoint_file, state)
+    return state
+
+def pending_iterations(state, iterations, output_file=None):
+    """
+    Iterations still to run: not completed, or completed but with their output (output_file(i)) missing.
+    """
+    completed = set(state["completed"])
+    if output_file is not None:
+        completed = {i for i in completed if os.path.exists(output_file(i))}
+    return [i for i in range(iterations) if i not in completed]
+
+def checkpoint_iteration(checkpoint_file, state):
+    """
+    on_done callback for run_iterations that records every finished iteration in the checkpoint.
+    """
+    def on_done(i, result):
+        state["completed"] = sorted(set(state["completed"]) | {i})
+        save_checkpoint(checkpoint_file, state)
+    return on_done
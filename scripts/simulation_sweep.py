@@ -0,0 +1,202 @@
+"""
+Simulation Sweep
+----------------
+Runs the simulation -> clock prediction pipeline for every scenario of a
+study (population x SNP set x framework x iteration count) on a bounded pool
+of worker processes, and summarises each scenario's delta age.
+It includes:
+- Building the job list from the populations, SNP sets, frameworks and
+  iteration counts (one job per scenario; a scenario whose mutation file is
+  missing is skipped)
+- Compiling each SNP set's intersected data once into a variant index shared
+  by its jobs
+- Loading the beta matrix (the rows read by the clocks and by any scenario)
+  and the clock models once per worker process
+- Per scenario, the simulation_pipeline.py outputs plus a consolidated
+  delta-age table, and one table of all the scenarios:
+  - <outdir>/<snp_set>/<population>/framework-<f>.<iterations>/
+  - <outdir>/<snp_set>/<population>/framework-<f>.<iterations>/delta_age_summary.csv
+  - <outdir>/sweep_delta_age.csv
+
+"""
+
+import os, sys
+import argparse
+import hashlib
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from beta_io import COMPACT_DTYPE, is_beta_store, load_beta
+from run_clocks import CLOCKS, clock_sites, load_clock_specs
+from simulation_pipeline import run_pipeline
+from simulation_runtime import master_entropy
+from variant_index import INDEX_SUFFIX, build_variant_index, load_variant_index, save_variant_index
+from instrumentation import add_arguments, configure_from_args, notice, span, traced
+
+POPULATIONS = ["afr", "ami", "amr", "asj", "eas", "fin", "mid", "nfe", "sas"]
+MUTATION_FILE = "{}.with_zygosity.txt"
+
+# beta matrix of the current worker process, loaded once for all its scenarios ...
+_sweep_state = {}
+
+def validate_beta_path(path):
+    if not (os.path.isfile(path) or is_beta_store(path)):
+        raise argparse.ArgumentTypeError(f"Beta matrix file or store not found: {path}")
+    return path
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Run the simulation -> clock prediction pipeline for every population, SNP set, framework and iteration count.")
+    parser.add_argument("beta_file", help="DNA methylation beta matrix file (TSV format) or beta store directory", type=validate_beta_path)
+    parser.add_argument("--snp-set", nargs=3, action="append", required=True, metavar=("NAME", "MUTATION_DIR", "INTERSECTED_DATA"),
+                        help="SNP set name, directory of [population].with_zygosity.txt files and its intersected data directory or variant index (repeatable)")
+    parser.add_argument("--populations", nargs="+", default=POPULATIONS, help="Populations to simulate (default: %(default)s)")
+    parser.add_argument("--frameworks", nargs="+", type=int, choices=[1, 2], default=[1, 2], help="Simulation frameworks to run (default: 1 2)")
+    parser.add_argument("--iterations", nargs="+", type=int, default=[10], help="Iteration counts to run (default: 10)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of scenarios run at the same time, one worker process each (default: 1)")
+    parser.add_argument("--seed", type=int, default=None, help="Master random seed; each scenario gets its own seed spawned from it")
+    parser.add_argument("--resume", action="store_true", help="Continue interrupted scenarios from their checkpoints")
+    parser.add_argument("--clocks", nargs="+", default=CLOCKS, help="biolearn clock names to run (default: %(default)s)")
+    parser.add_argument("--incremental", action="store_true", help="Re-score each simulation from its changed cells")
+    parser.add_argument("--compact", action="store_true", help="Hold the beta matrix as float32 instead of float64")
+    parser.add_argument("--outdir", default="sweep", help="Output directory of the sweep (default: sweep)")
+    add_arguments(parser)
+    return parser.parse_args()
+
+def load_post_simulation():
+    # post-simulation_analysis.py has '-' in its name, so load it from its path ...
+    name = "post_simulation_analysis"
+    if name not in sys.modules:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "post-simulation_analysis.py")
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+def compile_snp_sets(snp_sets, outdir):
+    # an intersected data directory is compiled once here instead of once per scenario ...
+    compiled = {}
+    for name, mutation_dir, intersected_data in snp_sets:
+        if os.path.isdir(intersected_data):
+            index_file = os.path.join(outdir, name + INDEX_SUFFIX)
+            save_variant_index(build_variant_index(intersected_data), index_file)
+            notice("Compiled {} into {} ...".format(intersected_data, index_file))
+            intersected_data = index_file
+        compiled[name] = (mutation_dir, intersected_data)
+    return compiled
+
+def scenario_key(snp_set, population, framework, iterations):
+    # spawn key from the scenario itself (not its position in the job list), so adding, removing or skipping
+    # other scenarios keeps its seed and cached outputs ...
+    digest = hashlib.sha256("{}/{}/{}/{}".format(snp_set, population, framework, iterations).encode()).digest()
+    return tuple(int.from_bytes(digest[k:k + 4], "little") for k in range(0, 16, 4))
+
+def build_jobs(snp_sets, populations, frameworks, iterations, entropy, outdir):
+    """
+    One job per scenario, each with its own seed spawned from the master seed and the scenario.
+    """
+    jobs = []
+    for name, (mutation_dir, intersected_data) in snp_sets.items():
+        for population in populations:
+            mutation_file = os.path.join(mutation_dir, MUTATION_FILE.format(population))
+            if not os.path.isfile(mutation_file):
+                notice("No {} mutation file for {}, skipping ...".format(name, population))
+                continue
+            for framework in frameworks:
+                for n in iterations:
+                    seed = int(np.random.SeedSequence(entropy, spawn_key=scenario_key(name, population, framework, n)).generate_state(1, np.uint64)[0])
+                    jobs.append({"snp_set":name, "population":population, "framework":framework, "iterations":n, "seed":seed,
+                                 "mutation_file":mutation_file, "intersected_data":intersected_data,
+                                 "outdir":os.path.join(outdir, name, population, "framework-{}.{}".format(framework, n))})
+    return jobs
+
+def sweep_rows(snp_sets, clocks):
+    # rows read by the clocks plus every variant CpG of the SNP sets (a superset of each scenario's overlap) ...
+    rows = clock_sites(clocks)
+    if rows is None:
+        return None
+    cpgs = set(rows)
+    for mutation_dir, intersected_data in snp_sets.values():
+        cpgs.update(load_variant_index(intersected_data).variants()["CpG"])
+    return sorted(cpgs)
+
+def _init_sweep_worker(beta_file, rows, clocks, compact):
+    # the beta matrix and the clock models are loaded once per worker ...
+    _sweep_state.clear()
+    with span("parse", file=beta_file) as record:
+        _sweep_state["df"] = load_beta(beta_file, rows, dtype=COMPACT_DTYPE if compact else np.float64)
+        record["items"] = len(_sweep_state["df"])
+    load_clock_specs(clocks)
+    notice("Worker {} loaded the beta matrix ({} CpGs) ...".format(os.getpid(), len(_sweep_state["df"])))
+
+@traced("aggregate", items=len)
+def summarize_scenario(original_file, simulated_files):
+    """
+    Consolidated delta-age table of one scenario: per clock, the average (over individuals) of the
+    mean and std of the absolute delta age and of the mean percent deviation across the simulations.
+    """
+    post = load_post_simulation()
+    original_df = post.read_table(original_file)
+    clocks = [clock for clock in post.CLOCKS_OF_INTEREST if clock in original_df.columns]
+    delta_age, percent_deviation, simulation_means = post.aggregate_simulations(original_df, simulated_files, clocks)
+    with np.errstate(all="ignore"):
+        return pd.DataFrame({"Average Delta Age": post.nanmean(delta_age.mean(), axis=0),
+                             "Std Delta Age": post.nanmean(delta_age.std(), axis=0),
+                             "Average Percent Deviation": post.nanmean(percent_deviation.mean(), axis=0)},
+                            index=pd.Index(clocks, name="clock"))
+
+def run_scenario(job, beta_file, clocks, incremental, compact, resume):
+    # simulate and score one scenario on the worker's beta matrix, then summarise its delta age ...
+    notice("Running {snp_set} {population} framework {framework} ({iterations} iterations) ...".format(**job))
+    original_file, simulated_files = run_pipeline(job["framework"], job["mutation_file"], job["intersected_data"], beta_file,
+                                                  iterations=job["iterations"], workers=1, seed=job["seed"], outdir=job["outdir"],
+                                                  incremental=incremental, clocks=clocks, compact=compact, resume=resume,
+                                                  df=_sweep_state["df"])
+    summary = summarize_scenario(original_file, simulated_files)
+    summary.to_csv(os.path.join(job["outdir"], "delta_age_summary.csv"))
+    return summary
+
+def run_sweep(beta_file, snp_sets, populations=POPULATIONS, frameworks=(1, 2), iterations=(10,), workers=1, seed=None, outdir="sweep",
+              clocks=CLOCKS, incremental=False, compact=False, resume=False):
+    """
+    Run every scenario and write the per-scenario summaries and the consolidated sweep table.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    entropy = master_entropy(seed)
+    notice("Sweep master seed {} ...".format(entropy))
+    snp_sets = compile_snp_sets(snp_sets, outdir)
+    jobs = build_jobs(snp_sets, populations, frameworks, iterations, entropy, outdir)
+    notice("{} scenarios to run ...".format(len(jobs)))
+    initargs = (beta_file, sweep_rows(snp_sets, clocks), clocks, compact)
+    options = (beta_file, clocks, incremental, compact, resume)
+    summaries = {}
+    if workers <= 1 or len(jobs) <= 1:
+        _init_sweep_worker(*initargs)
+        for k, job in enumerate(jobs):
+            summaries[k] = run_scenario(job, *options)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker, initargs=initargs) as pool:
+            futures = {pool.submit(run_scenario, job, *options): k for k, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                summaries[futures[future]] = future.result()
+                notice("Done {} of {} scenarios ...".format(len(summaries), len(jobs)))
+    # one table of all the scenarios, in job order ...
+    tables = []
+    for k, job in enumerate(jobs):
+        table = summaries[k].reset_index()
+        for column in ["iterations", "framework", "population", "snp_set"]:
+            table.insert(0, column, job[column])
+        tables.append(table)
+    sweep_df = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    sweep_file = os.path.join(outdir, "sweep_delta_age.csv")
+    sweep_df.to_csv(sweep_file, index=False)
+    notice("Done the sweep, results in {} ...".format(sweep_file))
+    return sweep_df
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    configure_from_args(args)
+    run_sweep(args.beta_file, args.snp_set, populations=args.populations, frameworks=args.frameworks, iterations=args.iterations,
+              workers=args.workers, seed=args.seed, outdir=args.outdir, clocks=args.clocks, incremental=args.incremental,
+              compact=args.compact, resume=args.resume)
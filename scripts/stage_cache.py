@@ -0,0 +1,102 @@
+"""
+Stage Cache
+-----------
+Fingerprints of the inputs of a pipeline stage, so a stage whose inputs have
+not changed reuses its outputs instead of running again.
+It includes:
+- Content digests of files and directories (beta stores), of the rows of one
+  population in the intersected data or variant index (a change to another
+  population's data keeps the digest), and of the code a stage runs
+- One fingerprint (SHA-256) of all the inputs of a stage
+- Stage manifests (<output>.stage.json) recording the inputs an output was
+  made from; an output is fresh while it exists and its inputs still match
+
+"""
+
+import os
+import json
+import hashlib
+import pandas as pd
+from variant_index import load_variant_index
+
+STAGE_SUFFIX = ".stage.json"
+DIGEST_CHUNKSIZE = 2**20
+
+# digests computed in this process, by path, size and modification time ...
+_digests = {}
+
+def file_digest(path):
+    """
+    SHA-256 of the file content (computed once per process while the file is unchanged).
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _digests:
+        digest = hashlib.sha256()
+        with open(path, "rb") as fH:
+            for chunk in iter(lambda: fH.read(DIGEST_CHUNKSIZE), b""):
+                digest.update(chunk)
+        _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+def path_digest(path):
+    """
+    Digest of a file, or of a directory (names and contents of all its files, e.g. a beta store).
+    """
+    if not os.path.isdir(path):
+        return file_digest(path)
+    digest = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for file in sorted(files):
+            full_path = os.path.join(root, file)
+            digest.update(os.path.relpath(full_path, path).encode())
+            digest.update(file_digest(full_path).encode())
+    return digest.hexdigest()
+
+def population_digest(intersected_data, population):
+    """
+    Digest of the rows of one population in the intersected data directory or compiled variant index.
+    """
+    table = load_variant_index(intersected_data).by_population(population)
+    digest = hashlib.sha256(population.encode())
+    digest.update(pd.util.hash_pandas_object(table, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def code_version(*modules):
+    """
+    Digest of the source files of the given modules (the code a stage runs).
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        digest.update(file_digest(module.__file__).encode())
+    return digest.hexdigest()
+
+def stage_fingerprint(inputs):
+    """
+    One SHA-256 of the stage inputs (a JSON-serialisable dict of digests and parameters).
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+def stage_manifest(output):
+    return output + STAGE_SUFFIX
+
+def is_fresh(output, inputs):
+    """
+    True when the output exists and was recorded with the same inputs.
+    """
+    manifest = stage_manifest(output)
+    if not (os.path.exists(output) and os.path.isfile(manifest)):
+        return False
+    with open(manifest, "r") as fH:
+        return json.load(fH).get("fingerprint") == stage_fingerprint(inputs)
+
+def record_stage(output, inputs):
+    """
+    Write the manifest of an output (atomically, next to it).
+    """
+    manifest = stage_manifest(output)
+    with open(manifest + ".tmp", "w") as fOut:
+        json.dump({"fingerprint": stage_fingerprint(inputs), "inputs": inputs}, fOut, sort_keys=True, default=str, indent=1)
+    os.replace(manifest + ".tmp", manifest)
+    return manifest
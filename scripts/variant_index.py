@@ -0,0 +1,155 @@
+"""
+Variant Index
+-------------
+Compiled table linking the gnomAD variants to the clock CpGs, shared by the
+simulation frameworks and clocks_weights_based_analysis.py.
+It includes:
+- Building the table once from the intersected data directory
+  (clocks_mutations_summary.*.txt), the [population].with_zygosity.txt files
+  and clock_coefficient.txt
+- One row per population, variant, CpG, clock and sub-clock (the
+  Horvath-pan-mammalian clock1/2/3) with the AF, zygosity and coefficient;
+  clock CpGs without a variant have an empty variant
+- A columnar .npz file and lookups by CpG, clock and population
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from instrumentation import traced
+
+INDEX_COLUMNS = ["variant", "population", "CpG", "clock", "subclock", "AF", "zygosity", "coefficient"]
+FLOAT_COLUMNS = ["AF", "coefficient"]
+POPULATIONS = ["afr", "amr", "ami", "asj", "fin", "nfe", "eas", "sas", "mid", "sa"]
+INDEX_SUFFIX = ".variant_index.npz"
+
+class VariantIndex:
+    """
+    Variant -> CpG -> clock table with row lookups by CpG, clock and population.
+    """
+    def __init__(self, table):
+        self.table = table[INDEX_COLUMNS].reset_index(drop=True)
+        self._groups = {}
+
+    def rows(self, column, key):
+        # positions of every key are computed once per column ...
+        if column not in self._groups:
+            self._groups[column] = self.table.groupby(column, sort=False).indices
+        return self.table.iloc[self._groups[column].get(key, [])]
+
+    def by_cpg(self, cpg):
+        return self.rows("CpG", cpg)
+
+    def by_clock(self, clock):
+        return self.rows("clock", clock)
+
+    def by_population(self, population):
+        return self.rows("population", population)
+
+    def variants(self):
+        """
+        Rows with a variant (one per population, variant, CpG and clock).
+        """
+        table = self.table[self.table["variant"] != ""]
+        return table.drop_duplicates(["population", "variant", "CpG", "clock"])
+
+def population_from_filename(file_name):
+    # the population code is a dot-separated token of the file name (its position differs between
+    # the all-SNP and common-SNP files) ...
+    tokens = os.path.basename(file_name).split(".")
+    found = [token for token in tokens if token in POPULATIONS]
+    if not found:
+        raise ValueError(f"No population code ({', '.join(POPULATIONS)}) in file name: {file_name}")
+    return found[-1]
+
+def read_intersected_data(intersected_data_dir):
+    # population, clock, CpG and variant of every CpG in the intersected files (in file and line order) ...
+    tables = []
+    for file in sorted(os.listdir(intersected_data_dir)):
+        data = pd.read_csv(os.path.join(intersected_data_dir, file), header=None, dtype=str, keep_default_na=False)
+        data = data[data[2] != "CpG"]  # header line (absent in some files) ...
+        tables.append(pd.DataFrame({
+            "population": population_from_filename(file),
+            "clock": data[1].to_numpy(),
+            "marker": data[2].to_numpy(),
+            "variant": data[data.columns[-1]].str.split(";").to_numpy(),
+        }))
+    table = pd.concat(tables, ignore_index=True).explode("variant", ignore_index=True)
+    table["variant"] = table["variant"].fillna("")
+    # one empty row for the CpGs without a variant, none for the CpGs listed with variants ...
+    keys = ["population", "clock", "marker"]
+    has_variant = (table["variant"] != "").groupby([table[key] for key in keys]).transform("any")
+    return table[(table["variant"] != "") | (~has_variant & ~table.duplicated(keys))]
+
+def read_zygosity_files(zygosity_dir):
+    tables = []
+    for file in sorted(os.listdir(zygosity_dir)):
+        if file.endswith(".with_zygosity.txt"):
+            data = pd.read_csv(os.path.join(zygosity_dir, file), sep="\t", dtype=str, keep_default_na=False)
+            tables.append(pd.DataFrame({
+                "population": population_from_filename(file),
+                "variant": data[data.columns[0]].to_numpy(),
+                "AF": data["AF"].astype(float).to_numpy(),
+                "zygosity": data[data.columns[2]].to_numpy(),
+            }))
+    return pd.concat(tables, ignore_index=True).drop_duplicates(["population", "variant"], keep="last")
+
+def read_coefficient_file(coefficient_file):
+    data = pd.read_csv(coefficient_file, sep="\t", dtype=str, keep_default_na=False)
+    subclock = data[data.columns[3]].str.strip() if len(data.columns) > 3 else ""
+    return pd.DataFrame({
+        "clock": data[data.columns[0]].str.strip(),
+        "marker": data[data.columns[1]].str.strip(),
+        "coefficient": data[data.columns[2]].astype(float),
+        "subclock": subclock,
+    })
+
+@traced("index_build", items=lambda index: len(index.table))
+def build_variant_index(intersected_data_dir, zygosity_dir=None, coefficient_file=None):
+    """
+    Compile the intersected data (plus the AF/zygosity files and the clock coefficients when given)
+    into one VariantIndex. Markers keep the clock file spelling ('*' suffix) only for matching;
+    the CpG column holds the array probe name.
+    """
+    table = read_intersected_data(intersected_data_dir)
+    if coefficient_file is not None:
+        # rows follow the clock file order, clock CpGs missing from every intersected file get an empty population ...
+        coefficients = read_coefficient_file(coefficient_file)
+        listed = pd.MultiIndex.from_frame(coefficients[["clock", "marker"]])
+        extra = table[~pd.MultiIndex.from_frame(table[["clock", "marker"]]).isin(listed)]
+        table = coefficients.merge(table, on=["clock", "marker"], how="left")
+        table = pd.concat([table, extra.assign(coefficient=np.nan, subclock="")], ignore_index=True)
+        table["population"] = table["population"].fillna("")
+        table["variant"] = table["variant"].fillna("")
+    else:
+        table = table.assign(coefficient=np.nan, subclock="")
+    if zygosity_dir is not None:
+        table = table.merge(read_zygosity_files(zygosity_dir), on=["population", "variant"], how="left")
+    else:
+        table = table.assign(AF=np.nan, zygosity="")
+    table["CpG"] = table["marker"].str.replace("*", "", regex=False)
+    table["subclock"] = table["subclock"].fillna("")
+    table["zygosity"] = table["zygosity"].fillna("")
+    return VariantIndex(table)
+
+@traced("write", items=lambda index_file: 1)
+def save_variant_index(index, index_file):
+    columns = {column: index.table[column].to_numpy(dtype=float if column in FLOAT_COLUMNS else str)
+               for column in INDEX_COLUMNS}
+    with open(index_file, "wb") as fOut:
+        np.savez_compressed(fOut, **columns)
+    return index_file
+
+def load_variant_index(path, zygosity_dir=None, coefficient_file=None):
+    """
+    Load a compiled index (.npz), or compile one in memory from an intersected data directory.
+    """
+    if os.path.isdir(path):
+        return build_variant_index(path, zygosity_dir, coefficient_file)
+    with np.load(path, allow_pickle=False) as saved:
+        table = pd.DataFrame({column: saved[column] for column in INDEX_COLUMNS})
+    for column in INDEX_COLUMNS:
+        if column not in FLOAT_COLUMNS:
+            table[column] = table[column].astype(object)
+    return VariantIndex(table)